@@ -272,7 +272,7 @@ class IsGrantedNetGroupRegexPermission(IsAuthenticated):
 
     @staticmethod
     def is_reserved_ip(ip):
-        network = Network.objects.filter(network__net_contains=ip).first()
+        network = Network.get_network_by_ip(ip)
         if network:
             return any(ip == str(i) for i in network.get_reserved_ipaddresses())
         return False
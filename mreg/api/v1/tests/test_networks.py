@@ -1,4 +1,4 @@
-from mreg.models import Host, Ipaddress, Network, PtrOverride
+from mreg.models import Host, Ipaddress, ModelChangeLog, Network, PtrOverride, ReverseZone
 
 from .tests import clean_and_save, MregAPITestCase
 
@@ -266,6 +266,19 @@ class NetworksTestCase(MregAPITestCase):
         response = self.assert_get('/networks/%s/used_host_list' % self.network_sample.network)
         self.assertEqual(response.json(), {'10.0.0.17': ['host1.example.org']})
 
+    def test_networks_get_host_list_sorted(self):
+        """used_list and used_host_list should be sorted by IP, and hosts by name."""
+        host_two = Host.objects.create(name='host2.example.org')
+        Ipaddress.objects.create(host=host_two, ipaddress='10.0.0.10')
+        Ipaddress.objects.create(host=host_two, ipaddress='10.0.0.9')
+        Ipaddress.objects.create(host=self.host_one, ipaddress='10.0.0.10')
+        path = '/networks/%s/' % self.network_sample.network
+        self.assertEqual(self.assert_get(path + 'used_list').json(), ['10.0.0.9', '10.0.0.10'])
+        response = self.assert_get(path + 'used_host_list').json()
+        self.assertEqual(list(response.items()),
+                         [('10.0.0.9', ['host2.example.org']),
+                          ('10.0.0.10', ['host1.example.org', 'host2.example.org'])])
+
     def test_ipv6_networks_get_usedlist_200_ok(self):
         """GET on /networks/<ipv6/mask>/used_list should return 200 ok and data."""
         Ipaddress.objects.create(host=self.host_one, ipaddress='2001:db8::beef')
@@ -302,6 +315,62 @@ class NetworksTestCase(MregAPITestCase):
         response = self.assert_get('/networks/%s/unused_list' % self.network_ipv6_sample.network)
         self.assertEqual(len(response.data), 3997)
 
+    def test_networks_get_unusedlist_paginated(self):
+        """GET on /networks/<ip/mask>/unused_list with limit should page with a cursor."""
+        Ipaddress.objects.create(host=self.host_one, ipaddress='10.0.0.5')
+        path = '/networks/%s/unused_list' % self.network_sample.network
+        response = self.assert_get(path + '?limit=2').json()
+        self.assertEqual(response['results'], ['10.0.0.4', '10.0.0.6'])
+        self.assertIn('after=10.0.0.6', response['next'])
+        response = self.assert_get(path + '?limit=2&after=10.0.0.6').json()
+        self.assertEqual(response['results'], ['10.0.0.7', '10.0.0.8'])
+        response = self.assert_get(path + '?limit=2&after=10.0.0.253').json()
+        self.assertEqual(response, {'results': ['10.0.0.254'], 'next': None})
+        self.assert_get_and_400(path + '?limit=0')
+        self.assert_get_and_400(path + '?limit=2&after=notanip')
+
+    def test_ipv6_networks_get_unusedlist_paginated(self):
+        """Paging is not limited to the first 4000 IPv6 hosts."""
+        path = '/networks/%s/unused_list' % self.network_ipv6_sample.network
+        response = self.assert_get(path + '?limit=1&after=2001:db8::ffff').json()
+        self.assertEqual(response['results'], ['2001:db8::1:0'])
+
+    def test_networks_get_unusedranges_200_ok(self):
+        """GET on /networks/<ip/mask>/unused_ranges should return the ranges."""
+        Ipaddress.objects.create(host=self.host_one, ipaddress='10.0.0.17')
+        Ipaddress.objects.create(host=self.host_one, ipaddress='10.0.0.18')
+        response = self.assert_get('/networks/%s/unused_ranges' % self.network_sample.network)
+        self.assertEqual(response.json(), [
+            {'first': '10.0.0.4', 'last': '10.0.0.16', 'count': 13},
+            {'first': '10.0.0.19', 'last': '10.0.0.254', 'count': 236},
+        ])
+        response = self.assert_get('/networks/%s/unused_ranges' % self.network_ipv6_sample.network)
+        self.assertEqual(response.json(), [
+            {'first': '2001:db8::4', 'last': '2001:db8:0:ff:ffff:ffff:ffff:ffff',
+             'count': 2**72 - 4},
+        ])
+
+    def test_networks_get_usage_200_ok(self):
+        """GET on /networks/usage/ should return the same counts as per network."""
+        host_two = Host.objects.create(name='host2.example.org')
+        Ipaddress.objects.create(host=self.host_one, ipaddress='10.0.0.17')
+        Ipaddress.objects.create(host=host_two, ipaddress='10.0.0.17')
+        Ipaddress.objects.create(host=self.host_one, ipaddress='10.0.0.1')
+        response = self.assert_get('/networks/usage/').json()
+        self.assertEqual(response['count'], 4)
+        usage = {i['network']: i for i in response['results']}
+        # 10.0.0.1 is reserved, and 10.0.0.17 is only used once.
+        self.assertEqual(usage['10.0.0.0/24'], {'network': '10.0.0.0/24', 'size': 256,
+                                                'reserved': 5, 'used': 1, 'unused': 250})
+        path = '/networks/%s/' % self.network_sample.network
+        self.assertEqual(self.assert_get(path + 'unused_count').data, 250)
+        self.assertEqual(usage['10.0.1.0/28'], {'network': '10.0.1.0/28', 'size': 16,
+                                                'reserved': 5, 'used': 0, 'unused': 11})
+        response = self.assert_get('/networks/usage/?vlan=135').json()
+        self.assertEqual(response['count'], 2)
+        for i in usage.values():
+            self.assertEqual(i['reserved'] + i['used'] + i['unused'], i['size'])
+
     def test_networks_get_first_unused_200_ok(self):
         """GET on /networks/<ip/mask>/first_unused should return 200 ok and data."""
         Ipaddress.objects.create(host=self.host_one, ipaddress='10.0.0.17')
@@ -314,6 +383,77 @@ class NetworksTestCase(MregAPITestCase):
         response = self.assert_get('/networks/%s/first_unused' % self.network_ipv6_sample.network)
         self.assertEqual(response.data, '2001:db8::4')
 
+    def test_networks_get_first_unused_skips_used_and_ptroverride(self):
+        """first_unused should skip ipaddresses and PtrOverrides, and find gaps."""
+        path = '/networks/%s/first_unused' % self.network_sample.network
+        for ip in ('10.0.0.4', '10.0.0.5', '10.0.0.7'):
+            Ipaddress.objects.create(host=self.host_one, ipaddress=ip)
+        PtrOverride.objects.create(host=self.host_one, ipaddress='10.0.0.6')
+        self.assertEqual(self.assert_get(path).data, '10.0.0.8')
+        PtrOverride.objects.filter(ipaddress='10.0.0.6').delete()
+        self.assertEqual(self.assert_get(path).data, '10.0.0.6')
+
+    def test_networks_unused_leaves_out_ptroverride(self):
+        """A PtrOverride on an otherwise free address makes it used for
+        every unused count and list."""
+        PtrOverride.objects.create(host=self.host_one, ipaddress='10.0.0.4')
+        path = '/networks/%s/' % self.network_sample.network
+        self.assertEqual(self.assert_get(path + 'first_unused').data, '10.0.0.5')
+        self.assertEqual(self.assert_get(path + 'unused_count').data, 250)
+        unused_list = self.assert_get(path + 'unused_list').data
+        self.assertEqual(len(unused_list), 250)
+        self.assertNotIn('10.0.0.4', unused_list)
+        self.assertEqual(self.assert_get(path + 'unused_list?limit=1').json()['results'], ['10.0.0.5'])
+        self.assertEqual(self.assert_get(path + 'unused_ranges').json(), [
+            {'first': '10.0.0.5', 'last': '10.0.0.254', 'count': 250},
+        ])
+        usage = {i['network']: i for i in self.assert_get('/networks/usage/').json()['results']}
+        self.assertEqual(usage['10.0.0.0/24'], {'network': '10.0.0.0/24', 'size': 256,
+                                                'reserved': 5, 'used': 1, 'unused': 250})
+
+    def test_networks_allocate(self):
+        """POST on /networks/<ip/mask>/allocate should claim the first unused IPs."""
+        path = '/networks/%s/allocate' % self.network_sample.network
+        Ipaddress.objects.create(host=self.host_one, ipaddress='10.0.0.5')
+        response = self.assert_post_and_201(path, {'host': self.host_one.name, 'count': 2})
+        self.assertEqual(response.json(), {'host': self.host_one.name,
+                                           'ipaddresses': ['10.0.0.4', '10.0.0.6']})
+        response = self.assert_post_and_201(path, {'host': self.host_one.name})
+        self.assertEqual(response.json()['ipaddresses'], ['10.0.0.7'])
+        self.assertEqual(Ipaddress.objects.filter(host=self.host_one).count(), 4)
+        self.assert_post_and_404(path, {'host': 'nonexistent.example.org'})
+        self.assert_post_and_400(path, {'host': self.host_one.name, 'count': 0})
+
+    def test_networks_allocate_same_as_unused_list(self):
+        """Allocate should give the first addresses of unused_list, which
+        leaves out PtrOverrides."""
+        path = '/networks/%s/' % self.network_sample.network
+        PtrOverride.objects.create(host=self.host_one, ipaddress='10.0.0.5')
+        unused = self.assert_get(path + 'unused_list?limit=3').json()['results']
+        self.assertEqual(unused, ['10.0.0.4', '10.0.0.6', '10.0.0.7'])
+        response = self.assert_post_and_201(path + 'allocate', {'host': self.host_one.name, 'count': 3})
+        self.assertEqual(response.json()['ipaddresses'], unused)
+
+    def test_networks_allocate_too_many_409_conflict(self):
+        """Allocating more IPs than available should allocate none, and
+        neither mark the zone as updated nor log the host."""
+        data = {'network': '172.16.0.0/29', 'description': 'Tiny network'}
+        self.assert_post('/networks/', data)
+        zone = ReverseZone.objects.create(name='16.172.in-addr.arpa', primary_ns='ns.example.org',
+                                          email='hostmaster@example.org', updated=False)
+        history = ModelChangeLog.objects.filter(table_name='host', table_row=self.host_one.id)
+        history_count = history.count()
+        path = '/networks/%s/allocate' % data['network']
+        self.assert_post_and_409(path, {'host': self.host_one.name, 'count': 4})
+        self.assertFalse(Ipaddress.objects.filter(host=self.host_one).exists())
+        zone.refresh_from_db()
+        self.assertFalse(zone.updated)
+        self.assertEqual(history.count(), history_count)
+        self.assert_post_and_201(path, {'host': self.host_one.name, 'count': 3})
+        zone.refresh_from_db()
+        self.assertTrue(zone.updated)
+        self.assertEqual(history.count(), history_count + 1)
+
     def test_networks_get_first_unued_on_full_network_404_not_found(self):
         """GET first unused IP on a full network should return 404 not found."""
         data = {
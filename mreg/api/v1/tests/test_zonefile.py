@@ -1,12 +1,32 @@
-from mreg.models import ForwardZone, Hinfo, Host, Ipaddress, ReverseZone
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-from .tests import MregAPITestCase, clean_and_save
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TransactionTestCase, override_settings
+
+from mreg import signals
+from mreg.models import (ForwardZone, Hinfo, Host, Ipaddress, ReverseZone, ZoneJournal,
+                         ZoneSnapshot)
+
+from mreg.api.v1.zonefile import (IPv4ReverseFile, ZoneFile, _export_snapshot,
+                                  _render_ipv4_reverse_chunk, commit_zone, export_zonefiles,
+                                  start_export_workers, zonefile_cache_key)
+
+from .tests import (MregAPITestCase, clean_and_save, create_forward_zone,
+                    create_reverse_zone)
 
 
 class APIZonefileTestCase(MregAPITestCase):
 
     def setUp(self):
         super().setUp()
+        cache.clear()
         self.forward = self.create_forward_zone('example.org')
 
         for name, ips in (('example.org', ('10.10.0.1', )),
@@ -42,7 +62,7 @@ class APIZonefileTestCase(MregAPITestCase):
 
     def _get_zone(self, zone):
         response = self.assert_get(f"/zonefiles/{zone.name}")
-        return response.data
+        return b"".join(response.streaming_content).decode()
 
     def test_get_forward(self):
         subname = f'subzone.{self.forward.name}'
@@ -53,7 +73,8 @@ class APIZonefileTestCase(MregAPITestCase):
         # Fix subzone NS error
         self._add_host(subname, ip='10.10.1.100')
         self._add_host(ns1, ip='10.10.1.101')
-        self._get_zone(self.forward)
+        data = self._get_zone(self.forward)
+        self.assertRegex(data, r'\nns1\.subzone +IN A +10\.10\.1\.101\n')
 
         # Finally add lots of entries to make sure we test everything when getting the zonefile.
         host1 = Host.objects.get(name='host1.example.org')
@@ -104,6 +125,209 @@ class APIZonefileTestCase(MregAPITestCase):
         self.assert_post("/srvs/", data)
         self._get_zone(self.forward)
 
+    def test_stream_matches_generate(self):
+        """The streamed zonefile must be identical to the generated one"""
+        data = self._get_zone(self.forward)
+        zone = ForwardZone.objects.get(name='example.org')
+        self.assertEqual(data, ZoneFile(zone).generate())
+        zonefile = ZoneFile(zone)
+        self.assertEqual("".join(zonefile.stream(chunk_size=1)), zonefile.generate())
+
+    def test_cache(self):
+        """Zones without pending changes are cached until a record changes"""
+        zone = ForwardZone.objects.get(name='example.org')
+        self._get_zone(zone)
+        self.assertIsNone(cache.get(zonefile_cache_key(zone)))
+        zone.updated = False
+        zone.save()
+        data = self._get_zone(zone)
+        self.assertEqual(cache.get(zonefile_cache_key(zone)), data)
+        self.assertEqual(self._get_zone(zone), data)
+        self._add_host('host3.example.org', ip='10.10.1.12')
+        self.assertIsNone(cache.get(zonefile_cache_key(zone)))
+        self.assertIn('host3', self._get_zone(zone))
+
+    @override_settings(ZONEFILE_CACHE_MAX_SIZE=100)
+    def test_cache_max_size(self):
+        """Zonefiles larger than ZONEFILE_CACHE_MAX_SIZE are not cached"""
+        zone = ForwardZone.objects.get(name='example.org')
+        zone.updated = False
+        zone.save()
+        data = self._get_zone(zone)
+        self.assertIn('host1', data)
+        self.assertIsNone(cache.get(zonefile_cache_key(zone)))
+
+    @override_settings(ZONEFILE_CACHE_MAX_SIZE=100)
+    def test_journal_too_large_to_cache(self):
+        """Zonefiles too large to cache are journaled all the same"""
+        commit = f'/zonefiles/{self.forward.name}/commit'
+        old_serial = self.assert_post_and_200(commit, {'force': True}).json()['serialno']
+        self._add_host('host3.example.org', ip='10.10.1.12')
+        self.assert_post_and_200(commit, {'force': True})
+        ret = self.assert_get(f'/zonefiles/{self.forward.name}/diff/{old_serial}').json()
+        self.assertIn('host3.example.org. IN A 10.10.1.12', ret['added'])
+
+    def test_etag(self):
+        """A matching If-None-Match gives 304, and any zone change a new ETag"""
+        path = f'/zonefiles/{self.forward.name}'
+        etag = self.assert_get(path)['ETag']
+        response = self.client.get(self._create_path(path), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self._add_host('host3.example.org', ip='10.10.1.12')
+        response = self.client.get(self._create_path(path), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_unchanged_zones(self):
+        """Zones without pending changes, forward and reverse, give 304 for
+        a matching If-None-Match"""
+        self.create_reverse_zone('10.10.in-addr.arpa')
+        for zone in (ForwardZone.objects.get(name='example.org'),
+                     ReverseZone.objects.get(name='10.10.in-addr.arpa')):
+            zone.updated = False
+            zone.save()
+            path = f'/zonefiles/{zone.name}'
+            response = self.assert_get(path)
+            self.assertIn('host1', b"".join(response.streaming_content).decode())
+            response = self.client.get(self._create_path(path), HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_get_is_read_only(self):
+        """Only a commit updates the serialno of a changed zone"""
+        zone = self.forward
+        zone.serialno_updated_at -= timedelta(minutes=10)
+        zone.save()
+        self._get_zone(zone)
+        self.assertEqual(ForwardZone.objects.get(id=zone.id).serialno, zone.serialno)
+        ret = self.assert_post_and_200(f'/zonefiles/{zone.name}/commit').json()
+        self.assertLess(zone.serialno, ret['serialno'])
+        self.assertFalse(ret['updated'])
+        self.assertEqual(ForwardZone.objects.get(id=zone.id).serialno, ret['serialno'])
+        # Nothing to commit
+        ret2 = self.assert_post_and_200(f'/zonefiles/{zone.name}/commit', {'force': True}).json()
+        self.assertEqual(ret2['serialno'], ret['serialno'])
+
+    def test_get_does_not_journal(self):
+        """Zones are journaled when committed, not when read"""
+        zone = self.forward
+        zone.updated = False
+        zone.save()
+        self._get_zone(zone)
+        self._get_zone(zone)
+        self.assertFalse(ZoneSnapshot.objects.filter(zone=zone.name).exists())
+
+    def test_diff(self):
+        """Only records changed between two committed serials are returned"""
+        zone = self.forward
+        commit = f'/zonefiles/{zone.name}/commit'
+        old_serial = self.assert_post_and_200(commit, {'force': True}).json()['serialno']
+        self._add_host('host3.example.org', ip='10.10.1.12')
+        new_serial = self.assert_post_and_200(commit, {'force': True}).json()['serialno']
+        self.assertLess(old_serial, new_serial)
+        ret = self.assert_get(f'/zonefiles/{zone.name}/diff/{old_serial}').json()
+        self.assertEqual(ret['to_serial'], new_serial)
+        self.assertEqual(ret['removed'], [])
+        self.assertIn('host3.example.org. IN A 10.10.1.12', ret['added'])
+        ret = self.assert_get(f'/zonefiles/{zone.name}/diff/{new_serial}').json()
+        self.assertEqual(ret['added'], [])
+        self.assert_get_and_404(f'/zonefiles/{zone.name}/diff/{old_serial - 1}')
+
+    def test_commit_changed_while_rendered(self):
+        """A zone changed while rendered for a commit is rendered again, and
+        the change journaled"""
+        zone = self.forward
+        commit = f'/zonefiles/{zone.name}/commit'
+        old_serial = self.assert_post_and_200(commit, {'force': True}).json()['serialno']
+        generate = ZoneFile.generate
+        hosts = ['host3.example.org']
+
+        def generate_and_change(zonefile):
+            data = generate(zonefile)
+            if hosts:
+                self._add_host(hosts.pop(), ip='10.10.1.12')
+            return data
+
+        with mock.patch.object(ZoneFile, 'generate', generate_and_change):
+            zone = commit_zone(ForwardZone.objects.get(id=zone.id), force=True)
+        self.assertLess(old_serial, zone.serialno)
+        ret = self.assert_get(f'/zonefiles/{zone.name}/diff/{old_serial}').json()
+        self.assertEqual(ret['to_serial'], zone.serialno)
+        self.assertIn('host3.example.org. IN A 10.10.1.12', ret['added'])
+
+    def test_commit_serialno_used_up(self):
+        """No journal is written when the day's serial numbers are used up"""
+        zone = self.forward
+        commit = f'/zonefiles/{zone.name}/commit'
+        serialno = self.assert_post_and_200(commit, {'force': True}).json()['serialno']
+        last = serialno // 100 * 100 + 99
+        ForwardZone.objects.filter(id=zone.id).update(serialno=last)
+        self._add_host('host3.example.org', ip='10.10.1.12')
+        self.assertEqual(self.assert_post_and_200(commit, {'force': True}).json()['serialno'], last)
+        self.assertFalse(ZoneJournal.objects.filter(zone=zone.name).exists())
+        self.assertNotEqual(ZoneSnapshot.objects.get(zone=zone.name).serialno, last)
+
+    def test_export(self):
+        """Only zones with changed records are exported with a new serialno"""
+        with tempfile.TemporaryDirectory() as outdir, \
+                override_settings(ZONEFILE_EXPORT_DIR=outdir):
+            ret = self.assert_post_and_200('/zonefiles/export/').json()
+            self.assertEqual(ret, {'exported': ['example.org'], 'unchanged': []})
+            zone = ForwardZone.objects.get(name='example.org')
+            self.assertFalse(zone.updated)
+            with open(os.path.join(outdir, zone.name)) as f:
+                data = f.read()
+            self.assertIn(f'{zone.serialno}', data)
+            self.assertIn('host1', data)
+            ret = self.assert_post_and_200('/zonefiles/export/').json()
+            self.assertEqual(ret, {'exported': [], 'unchanged': []})
+            # Marked as updated, but no records changed
+            zone.updated = True
+            zone.save()
+            ret = self.assert_post_and_200('/zonefiles/export/').json()
+            self.assertEqual(ret, {'exported': [], 'unchanged': ['example.org']})
+            self.assertEqual(ForwardZone.objects.get(id=zone.id).serialno, zone.serialno)
+            self._add_host('host3.example.org', ip='10.10.1.12')
+            ret = self.assert_post_and_200('/zonefiles/export/').json()
+            self.assertEqual(ret['exported'], ['example.org'])
+            with open(os.path.join(outdir, zone.name)) as f:
+                self.assertIn('host3', f.read())
+
+    def test_export_changed_while_exported(self):
+        """A zone changed while exported is rendered again with the change"""
+        generate = ZoneFile.generate
+        hosts = ['host3.example.org']
+
+        def generate_and_change(zonefile):
+            data = generate(zonefile)
+            if hosts:
+                self._add_host(hosts.pop(), ip='10.10.1.12')
+            return data
+
+        with tempfile.TemporaryDirectory() as outdir, \
+                mock.patch.object(ZoneFile, 'generate', generate_and_change):
+            self.assertEqual(export_zonefiles(outdir), [('example.org', 'exported')])
+            with open(os.path.join(outdir, 'example.org')) as f:
+                self.assertIn('host3', f.read())
+        self.assertFalse(ForwardZone.objects.get(name='example.org').updated)
+
+    def test_export_not_batched(self):
+        """The export does not run in a batch_changes() block, which would
+        be a single transaction for every zone"""
+        active = []
+
+        def export(outdir):
+            active.append(getattr(signals._batches, 'active', None))
+            return []
+
+        with override_settings(ZONEFILE_EXPORT_DIR='/nonexistent'), \
+                mock.patch('mreg.api.v1.views_zones.export_zonefiles', export):
+            self.assert_post_and_200('/zonefiles/export/')
+        self.assertEqual(active, [None])
+
+    def test_export_not_configured(self):
+        ret = self.client.post(self._create_path('/zonefiles/export/'))
+        self.assertEqual(ret.status_code, 503)
+
     def test_get_nonexistent(self):
         self.assert_get_and_404("/zonefiles/ops")
 
@@ -112,3 +336,66 @@ class APIZonefileTestCase(MregAPITestCase):
         rev_v6 = self.create_reverse_zone('0.0.0.0.8.b.d.0.1.0.0.2.ip6.arpa')
         self._get_zone(rev_v4)
         self._get_zone(rev_v6)
+
+    def test_reverse_zone_chunks(self):
+        """Rendering a reverse zone in sub-networks must give the same PTRs."""
+        self.create_reverse_zone('10.10.in-addr.arpa')
+        zonefile = IPv4ReverseFile(ReverseZone.objects.get(name='10.10.in-addr.arpa'))
+        self.assertEqual(len(zonefile.get_chunks(1)), 1)
+        self.assertEqual(len(zonefile.get_chunks(12)), 16)
+        self.assertEqual(len(zonefile.get_chunks(1000)), 256)
+        chunks = zonefile.get_chunks(16)
+        self.assertEqual([str(network) for network in chunks[:2]], ['10.10.0.0/20', '10.10.16.0/20'])
+        self.assertEqual(''.join(''.join(zonefile.get_ptrs(network)) for network in chunks),
+                         ''.join(zonefile.get_ptrs()))
+
+
+class ExportZonefilesCommandTestCase(TransactionTestCase):
+    """The zones are rendered in worker processes, which must see the
+    committed data."""
+
+    def test_export_workers(self):
+        zones = [create_forward_zone(), create_reverse_zone()]
+        host = Host.objects.create(name='host1.example.org')
+        Ipaddress.objects.create(host=host, ipaddress='10.10.1.10')
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as outdir:
+            call_command('export_zonefiles', outdir, workers=2, stdout=out)
+            self.assertEqual(sorted(out.getvalue().splitlines()),
+                             ['10.10.in-addr.arpa: exported', 'example.org: exported'])
+            for zone in zones:
+                with open(os.path.join(outdir, zone.name)) as f:
+                    self.assertIn('host1', f.read())
+        for zone in zones:
+            exported = type(zone).objects.get(id=zone.id)
+            self.assertFalse(exported.updated)
+            self.assertLess(zone.serialno, exported.serialno)
+
+    def test_reverse_chunks_read_one_snapshot(self):
+        """The processes rendering a reverse zone in parallel see it as when
+        the rendering started, and not later changes"""
+        zone = create_reverse_zone()
+        host = Host.objects.create(name='host1.example.org')
+        Ipaddress.objects.create(host=host, ipaddress='10.10.1.10')
+
+        def add_ipaddress():
+            try:
+                Ipaddress.objects.create(host=host, ipaddress='10.10.2.10')
+            finally:
+                connection.close()
+
+        zonefile = IPv4ReverseFile(zone)
+        with start_export_workers(2) as executor:
+            with transaction.atomic():
+                snapshot = _export_snapshot()
+                # Committed by another connection after the snapshot
+                thread = threading.Thread(target=add_ipaddress)
+                thread.start()
+                thread.join()
+                chunks = [(snapshot, zone.id, network) for network in zonefile.get_chunks(4)]
+                data = "".join(executor.map(_render_ipv4_reverse_chunk, chunks))
+            self.assertIn('$ORIGIN 1.10.10.in-addr.arpa.', data)
+            self.assertNotIn('$ORIGIN 2.10.10.in-addr.arpa.', data)
+            data = IPv4ReverseFile(zone).generate_parallel(executor)
+        self.assertIn('$ORIGIN 2.10.10.in-addr.arpa.', data)
+        self.assertEqual(data, ZoneFile(zone).generate())
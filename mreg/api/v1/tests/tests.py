@@ -1,6 +1,8 @@
+import json
 from datetime import timedelta
 from operator import itemgetter
 from unittest import skip
+from urllib.parse import urlencode
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -512,25 +514,29 @@ class APIHostsIdna(MregAPITestCase):
     def _add_data(self, data):
         self.assert_post_and_201('/hosts/', data)
 
+    def _get_zone(self, zone):
+        response = self.assert_get(f'/zonefiles/{zone.name}')
+        return b''.join(response.streaming_content).decode()
+
     def test_hosts_idna_forward(self):
         """Test that a hostname outside ASCII 128 is handled properly"""
         zone = create_forward_zone()
         self._add_data(self.data_v4)
-        response = self.assert_get(f'/zonefiles/{zone.name}')
-        self.assertTrue('xn--5cab8c                     IN A      10.10.0.1' in response.data)
+        data = self._get_zone(zone)
+        self.assertTrue('xn--5cab8c                     IN A      10.10.0.1' in data)
 
     def test_hosts_idna_reverse_v4(self):
         zone = create_reverse_zone()
         self._add_data(self.data_v4)
-        response = self.assert_get(f'/zonefiles/{zone.name}')
-        self.assertTrue('xn--5cab8c.example.org.' in response.data)
+        data = self._get_zone(zone)
+        self.assertTrue('xn--5cab8c.example.org.' in data)
 
     def test_hosts_idna_reverse_v6(self):
         zone = create_reverse_zone('0.0.0.0.8.b.d.0.1.0.0.2.ip6.arpa')
         data = {'name': 'æøå.example.org', "ipaddress": '2001:db8::1'}
         self._add_data(data)
-        response = self.assert_get(f'/zonefiles/{zone.name}')
-        self.assertTrue('xn--5cab8c.example.org.' in response.data)
+        data = self._get_zone(zone)
+        self.assertTrue('xn--5cab8c.example.org.' in data)
 
 
 class HinfoTestCase(MregAPITestCase):
@@ -1345,3 +1351,57 @@ class APIModelChangeLogsTestCase(MregAPITestCase):
         """Get on /history/hosts/<pk> should return a list of dicts containing entries for that host"""
         response = self.assert_get('/history/hosts/{}'.format(self.host_one.id))
         self.assertIsInstance(response.data, list)
+
+    def test_history_get_table_names(self):
+        ModelChangeLog.objects.create(table_name='atable', table_row=1, data={}, action='saved')
+        ModelChangeLog.objects.create(table_name='atable', table_row=2, data={}, action='saved')
+        response = self.assert_get('/history/')
+        self.assertEqual(response.data, ['atable', 'hosts'])
+
+    def test_history_host_paginated(self):
+        """With limit the entries are returned in pages, linked by next"""
+        for ttl in (600, 900):
+            ModelChangeLog.objects.create(table_name='hosts', table_row=self.host_one.id,
+                                          data=dict(self.log_data, ttl=ttl), action='saved')
+        path = '/history/hosts/{}?limit=2&diff=1'.format(self.host_one.id)
+        ret = self.assert_get(path).json()
+        self.assertEqual(len(ret['results']), 2)
+        self.assertEqual(ret['results'][1]['changes'], {'ttl': [300, 600]})
+        ret = self.assert_get(ret['next']).json()
+        self.assertEqual(len(ret['results']), 1)
+        self.assertEqual(ret['results'][0]['changes'], {'ttl': [600, 900]})
+        self.assertIsNone(ret['next'])
+        self.assert_get_and_400('/history/hosts/{}?after=0'.format(self.host_one.id))
+
+    def test_history_host_diff(self):
+        """With diff only the changes from the previous entry are returned"""
+        ModelChangeLog.objects.create(table_name='hosts', table_row=self.host_one.id,
+                                      data=dict(self.log_data, ttl=600), action='saved')
+        response = self.assert_get('/history/hosts/{}?diff=1'.format(self.host_one.id))
+        first, second = response.data
+        self.assertEqual(first['data'], self.log_data)
+        self.assertEqual(second['changes'], {'ttl': [300, 600]})
+
+    def test_history_search(self):
+        """Search for the hosts which had an ipaddress at a given time"""
+        def _log(name, ips, timestamp):
+            entry = ModelChangeLog.objects.create(table_name='host', table_row=ord(name[0]),
+                                                  data={'name': name, 'ipaddresses': ips},
+                                                  action='saved')
+            ModelChangeLog.objects.filter(id=entry.id).update(timestamp=timestamp)
+
+        now = timezone.now()
+        _log('a.example.org', ['10.0.0.1'], now - timedelta(days=2))
+        _log('a.example.org', ['10.0.0.2'], now - timedelta(days=1))
+        _log('b.example.org', ['10.0.0.1'], now - timedelta(hours=1))
+
+        def _search(**params):
+            params['contains'] = json.dumps({'ipaddresses': ['10.0.0.1']})
+            ret = self.assert_get('/history/host/?' + urlencode(params)).json()
+            return [i['data']['name'] for i in ret['results']]
+
+        self.assertEqual(_search(), ['a.example.org', 'b.example.org'])
+        self.assertEqual(_search(at=(now - timedelta(hours=36)).isoformat()), ['a.example.org'])
+        self.assertEqual(_search(at=(now - timedelta(hours=12)).isoformat()), [])
+        self.assertEqual(_search(at=now.isoformat()), ['b.example.org'])
+        self.assert_get_and_400('/history/host/?contains=10.0.0.1')
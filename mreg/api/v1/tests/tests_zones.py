@@ -1,6 +1,7 @@
 from unittest import skip
 
-from mreg.models import (ForwardZone, Host, NameServer, ReverseZone)
+from mreg.models import (ForwardZone, Host, Ipaddress, NameServer, PtrOverride,
+                         ReverseZone)
 from mreg.utils import create_serialno
 
 from .tests import clean_and_save, MregAPITestCase
@@ -229,6 +230,20 @@ class ReverseZonesTestCase(MregAPITestCase):
         """"Deleting a non-existing entry should return 404"""
         self.assert_delete_and_404(self.basepath + '1.11.in-addr.arpa')
 
+    def test_zones_multiple_ip_no_ptr(self):
+        """Addresses used by multiple hosts without a PtrOverride are reported"""
+        path = self.basepath + self.zone_one.name + '/multiple_ip_no_ptr'
+        Ipaddress.objects.create(host=self.host_one, ipaddress='10.0.0.5')
+        Ipaddress.objects.create(host=self.host_two, ipaddress='10.0.0.5')
+        Ipaddress.objects.create(host=self.host_two, ipaddress='10.0.0.6')
+        # The second host got a PtrOverride for the first one.
+        self.assertEqual(self.assert_get(path).json(), [])
+        PtrOverride.objects.filter(ipaddress='10.0.0.5').delete()
+        self.assertEqual(self.assert_get(path).json(),
+                         [{'ipaddress': '10.0.0.5', 'count': 2,
+                           'hosts': ['ns1.example.org', 'ns2.example.org']}])
+        self.assert_get_and_404(self.basepath + '1.11.in-addr.arpa/multiple_ip_no_ptr')
+
 
 class ZonesForwardDelegationTestCase(MregAPITestCase):
     """ This class defines test testsuite for api/zones/forward/<name>/delegations/
@@ -40,7 +40,9 @@ urlpatterns = [
     path('srvs/<pk>', views.SrvDetail.as_view()),
     path('networks/', views.NetworkList.as_view()),
     path('networks/ip/<ip>', views.network_by_ip),
+    path('networks/usage/', views.NetworkUsageList.as_view()),
     re_path(r'^networks/(?P<network>[^/]+/\d+)$', views.NetworkDetail.as_view()),
+    re_path(r'^networks/(?P<network>[^/]+/\d+)/allocate$', views.NetworkAllocate.as_view()),
     re_path(r'^networks/(?P<network>[^/]+/\d+)/first_unused', views.network_first_unused),
     re_path(r'^networks/(?P<network>[^/]+/\d+)/ptroverride_list', views.network_ptroverride_list),
     re_path(r'^networks/(?P<network>[^/]+/\d+)/ptroverride_host_list', views.network_ptroverride_host_list),
@@ -50,6 +52,7 @@ urlpatterns = [
     re_path(r'^networks/(?P<network>[^/]+/\d+)/used_host_list', views.network_used_host_list),
     re_path(r'^networks/(?P<network>[^/]+/\d+)/unused_count', views.network_unused_count),
     re_path(r'^networks/(?P<network>[^/]+/\d+)/unused_list', views.network_unused_list),
+    re_path(r'^networks/(?P<network>[^/]+/\d+)/unused_ranges', views.network_unused_ranges),
     path('txts/', views.TxtList.as_view()),
     path('txts/<pk>', views.TxtDetail.as_view()),
     path('zones/forward/', views_zones.ForwardZoneList.as_view()),
@@ -63,9 +66,15 @@ urlpatterns = [
     re_path(r'^zones/reverse/(?P<name>(\d+/)?[^/]+)/delegations/$', views_zones.ReverseZoneDelegationList.as_view()),
     re_path(r'^zones/reverse/(?P<name>(\d+/)?[^/]+)/delegations/(?P<delegation>(.*))', views_zones.ReverseZoneDelegationDetail.as_view()),
     re_path(r'^zones/reverse/(?P<name>(\d+/)?[^/]+)/nameservers$', views_zones.ReverseZoneNameServerDetail.as_view()),
+    re_path(r'^zones/reverse/(?P<name>(\d+/)?[^/]+)/multiple_ip_no_ptr$', views_zones.reverse_zone_multiple_ip_no_ptr),
+    path('zonefiles/export/', views_zones.ZoneFileExport.as_view()),
+    re_path(r'^zonefiles/(?P<name>(\d+/)?[^/]+)/commit$', views_zones.ZoneFileCommit.as_view()),
+    re_path(r'^zonefiles/(?P<name>(\d+/)?[^/]+)/diff/(?P<from_serial>\d+)(/(?P<to_serial>\d+))?$',
+            views_zones.ZoneFileDiff.as_view()),
     re_path(r'^zonefiles/(?P<name>(\d+/)?[^/]+)', views_zones.ZoneFileDetail.as_view()),
     path('permissions/netgroupregex/', views.NetGroupRegexPermissionList.as_view()),
     path('permissions/netgroupregex/<pk>', views.NetGroupRegexPermissionDetail.as_view()),
     path('history/', views.ModelChangeLogList.as_view()),
+    path('history/<table>/', views.ModelChangeLogSearch.as_view()),
     path('history/<table>/<pk>', views.ModelChangeLogDetail.as_view()),
 ]
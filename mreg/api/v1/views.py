@@ -1,15 +1,21 @@
-import bisect
 import ipaddress
-from collections import defaultdict
+import json
+from itertools import groupby, islice
+from operator import itemgetter
 
 from django.db import transaction
+from django.db.models import Q
+from django.http import Http404
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from rest_framework import (filters, generics, status)
 from rest_framework.decorators import api_view
 from rest_framework.exceptions import MethodNotAllowed, ParseError
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.views import APIView
 
 from rest_framework_extensions.etag.mixins import ETAGMixin
@@ -23,11 +29,13 @@ from mreg.api.permissions import (IsAuthenticatedAndReadOnly,
                                   IsSuperGroupMember,
                                   IsSuperOrAdminOrReadOnly,
                                   IsSuperOrGroupAdminOrReadOnly,
-                                  IsSuperOrNetworkAdminMember,)
+                                  IsSuperOrNetworkAdminMember,
+                                  is_super_or_admin)
 from mreg.models import (Cname, Hinfo, Host, HostGroup, Ipaddress, Loc,
                          ModelChangeLog, Mx, NameServer, Naptr, Network,
                          PtrOverride, Srv, Sshfp, Txt)
 
+from .pagination import StandardResultsSetPagination
 from .serializers import (CnameSerializer, HinfoSerializer,
                           HostSerializer, IpaddressSerializer,
                           LocSerializer,
@@ -660,6 +668,24 @@ class NetworkList(MregListCreateAPIView):
         return super().post(request, *args, **kwargs)
 
 
+class NetworkUsageList(MregMixin, generics.ListAPIView):
+    """
+    get:
+    Lists the size, and the number of reserved, used and unused addresses,
+    of the networks, which add up to the size. Addresses of Ipaddresses and
+    PtrOverrides are used. Takes the same filters as the list of networks.
+    """
+    queryset = Network.objects.all()
+
+    def get_queryset(self):
+        qs = super().get_queryset()
+        return NetworkFilterSet(data=self.request.GET, queryset=qs).filter()
+
+    def list(self, request, *args, **kwargs):
+        networks = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        return self.get_paginated_response(Network.get_usage(networks))
+
+
 class NetworkDetail(MregRetrieveUpdateDestroyAPIView):
     """
     get:
@@ -687,8 +713,7 @@ class NetworkDetail(MregRetrieveUpdateDestroyAPIView):
 
     def delete(self, request, *args, **kwargs):
         network = self.get_object()
-        used_ipaddresses = network.get_used_ipaddresses()
-        if used_ipaddresses:
+        if network._get_used_ipaddresses().exists():
             return Response({'ERROR': 'Network contains IP addresses that are in use'},
                             status=status.HTTP_409_CONFLICT)
 
@@ -696,13 +721,60 @@ class NetworkDetail(MregRetrieveUpdateDestroyAPIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class NetworkAllocate(generics.GenericAPIView):
+    """
+    post:
+    Allocates the first "count" (default 1) unused ip addresses on the
+    network to the existing host "host", and returns them. The addresses
+    are the first ones of unused_list, so neither reserved nor used by an
+    ip address or a PTR override. Allocations on the same network are
+    serialized, so concurrent requests never get the same address.
+    """
+    queryset = Network.objects.all()
+    permission_classes = (IsGrantedNetGroupRegexPermission, )
+    lookup_field = 'network'
+
+    max_count = 256
+
+    def post(self, request, *args, **kwargs):
+        network = self.get_object()
+        if 'host' not in request.data:
+            raise ParseError(detail='host is required')
+        host = get_object_or_404(Host, name=request.data['host'])
+        try:
+            count = int(request.data.get('count', 1))
+        except (TypeError, ValueError) as error:
+            raise ParseError(detail=str(error))
+        if not 0 < count <= self.max_count:
+            raise ParseError(detail=f'count must be between 1 and {self.max_count}')
+
+        with transaction.atomic():
+            network.lock()
+            # Check the addresses before creating any, so nothing is logged
+            # or marked as updated for an allocation which is refused.
+            ips = [str(ip) for ip in islice(network.iter_unused_ipaddresses(), count)]
+            if len(ips) < count:
+                content = {'ERROR': f'Only {len(ips)} available IPs'}
+                return Response(content, status=status.HTTP_409_CONFLICT)
+            if not is_super_or_admin(request.user):
+                for ip in ips:
+                    if not IsGrantedNetGroupRegexPermission.has_perm(request.user, host.name, [ip]):
+                        self.permission_denied(request)
+            for ip in ips:
+                Ipaddress.objects.create(host=host, ipaddress=ip)
+        return Response({'host': host.name, 'ipaddresses': ips},
+                        status=status.HTTP_201_CREATED)
+
+
 @api_view()
 def network_by_ip(request, *args, **kwargs):
     try:
         ip = ipaddress.ip_address(kwargs['ip'])
     except ValueError as error:
         raise ParseError(detail=str(error))
-    network = get_object_or_404(Network, network__net_contains_or_equals=ip)
+    network = Network.get_network_by_ip(ip, strict=False)
+    if network is None:
+        raise Http404
     serializer = NetworkSerializer(network)
     return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -720,9 +792,7 @@ def network_first_unused(request, *args, **kwargs):
 
 def _network_ptroverride_list(kwargs):
     network = get_object_or_404(Network, network=kwargs['network'])
-    from_ip = str(network.network.network_address)
-    to_ip = str(network.network.broadcast_address)
-    return PtrOverride.objects.filter(ipaddress__range=(from_ip, to_ip))
+    return PtrOverride.objects.filter(ipaddress__net_contained_or_equal=network.network)
 
 
 @api_view()
@@ -735,10 +805,8 @@ def network_ptroverride_list(request, *args, **kwargs):
 @api_view()
 def network_ptroverride_host_list(request, *args, **kwargs):
     ptrs = _network_ptroverride_list(kwargs)
-    ret = dict()
-    info = ptrs.values_list('host__name', 'ipaddress')
-    for host, ip in sorted(info, key=lambda i: ipaddress.ip_address(i[1])):
-        ret[ip] = host
+    info = ptrs.order_by('ipaddress').values_list('ipaddress', 'host__name')
+    ret = dict(info.iterator())
     return Response(ret, status=status.HTTP_200_OK)
 
 
@@ -758,17 +826,18 @@ def network_used_count(request, *args, **kwargs):
 @api_view()
 def network_used_list(request, *args, **kwargs):
     network = get_object_or_404(Network, network=kwargs['network'])
-    used_ipaddresses = list(map(str, sorted(network.get_used_ipaddresses())))
+    ips = network._get_used_ipaddresses().order_by('ipaddress').distinct()
+    used_ipaddresses = list(ips.values_list('ipaddress', flat=True))
     return Response(used_ipaddresses, status=status.HTTP_200_OK)
 
 
 @api_view()
 def network_used_host_list(request, *args, **kwargs):
     network = get_object_or_404(Network, network=kwargs['network'])
-    ret = defaultdict(list)
-    info = network._get_used_ipaddresses().values_list('host__name', 'ipaddress')
-    for host, ip in sorted(info, key=lambda i: ipaddress.ip_address(i[1])):
-        bisect.insort(ret[ip], host)
+    info = network._get_used_ipaddresses().order_by('ipaddress', 'host__name')
+    info = info.values_list('ipaddress', 'host__name')
+    ret = {ip: [host for _, host in group]
+           for ip, group in groupby(info.iterator(), key=itemgetter(0))}
     return Response(ret, status=status.HTTP_200_OK)
 
 
@@ -780,9 +849,47 @@ def network_unused_count(request, *args, **kwargs):
 
 @api_view()
 def network_unused_list(request, *args, **kwargs):
+    """
+    Returns the unused ip addresses on the network. With the "limit" and
+    optionally the "after" query parameters, it returns a page of at most
+    limit addresses following the address in after, and a link to the next
+    page in "next".
+    """
     network = get_object_or_404(Network, network=kwargs['network'])
-    unused_ipaddresses = list(map(str, sorted(network.get_unused_ipaddresses())))
-    return Response(unused_ipaddresses, status=status.HTTP_200_OK)
+    params = request.query_params
+    if 'limit' not in params and 'after' not in params:
+        unused_ipaddresses = list(map(str, sorted(network.get_unused_ipaddresses())))
+        return Response(unused_ipaddresses, status=status.HTTP_200_OK)
+
+    try:
+        limit = int(params.get('limit', StandardResultsSetPagination.page_size))
+        after = params.get('after')
+        if after is not None:
+            after = ipaddress.ip_address(after)
+    except ValueError as error:
+        raise ParseError(detail=str(error))
+    if limit < 1:
+        raise ParseError(detail='limit must be a positive integer')
+    limit = min(limit, StandardResultsSetPagination.max_page_size)
+    unused = islice(network.iter_unused_ipaddresses(after=after), limit + 1)
+    results = list(map(str, unused))
+    next_link = None
+    if len(results) > limit:
+        results = results[:limit]
+        url = request.build_absolute_uri()
+        next_link = replace_query_param(url, 'after', results[-1])
+    return Response({'results': results, 'next': next_link}, status=status.HTTP_200_OK)
+
+
+@api_view()
+def network_unused_ranges(request, *args, **kwargs):
+    """
+    Returns the unused ip addresses on the network as a list of ranges.
+    """
+    network = get_object_or_404(Network, network=kwargs['network'])
+    ranges = [{'first': str(first), 'last': str(last), 'count': int(last) - int(first) + 1}
+              for first, last in network.get_unused_ranges()]
+    return Response(ranges, status=status.HTTP_200_OK)
 
 
 class TxtList(HostPermissionsListCreateAPIView):
@@ -853,7 +960,7 @@ class ModelChangeLogList(generics.ListAPIView):
 
     def get(self, request, *args, **kwargs):
         # Return a list of available tables there are logged histories for.
-        tables = list({value['table_name'] for value in self.queryset.values('table_name')})
+        tables = ModelChangeLog.get_table_names()
         return Response(data=tables, status=status.HTTP_200_OK)
 
 
@@ -861,6 +968,11 @@ class ModelChangeLogDetail(generics.RetrieveAPIView):
     """
     get:
     Retrieve all log entries for an object in a table.
+    With "diff", every entry but the first only has the changes from the
+    previous entry.
+    With the "limit" and optionally the "after" query parameters, it returns
+    a page of at most limit entries following the entry with id after, and a
+    link to the next page in "next".
 
     patch:
     Not implemented. Changing a log entry doesn't really make sense, and log entries are handles internally.
@@ -871,10 +983,82 @@ class ModelChangeLogDetail(generics.RetrieveAPIView):
     def get(self, request, *args, **kwargs):
         query_table = self.kwargs['table']
         query_row = self.kwargs['pk']
-        logs_by_date = [vals for vals in self.queryset.filter(table_name=query_table,
-                                                              table_row=query_row).order_by('timestamp').values()]
+        params = request.query_params
+        logs = self.queryset.filter(table_name=query_table,
+                                    table_row=query_row).order_by('timestamp', 'id')
+        paginate = 'limit' in params or 'after' in params
+        previous = None
+        if paginate:
+            try:
+                limit = int(params.get('limit', StandardResultsSetPagination.page_size))
+                after = params.get('after')
+                if after is not None:
+                    after = logs.get(id=int(after))
+            except ValueError as error:
+                raise ParseError(detail=str(error))
+            except ModelChangeLog.DoesNotExist:
+                raise ParseError(detail='after must be the id of an entry of this object')
+            if limit < 1:
+                raise ParseError(detail='limit must be a positive integer')
+            limit = min(limit, StandardResultsSetPagination.max_page_size)
+            if after is not None:
+                previous = after.data
+                logs = logs.filter(Q(timestamp__gt=after.timestamp) |
+                                   Q(timestamp=after.timestamp, id__gt=after.id))
+            logs = logs[:limit + 1]
+        logs_by_date = [vals for vals in logs.values()]
+
+        if params.get('diff') in ('1', 'true', 'True'):
+            for entry in logs_by_date:
+                data = entry.pop('data')
+                if previous is None:
+                    entry['data'] = data
+                else:
+                    entry['changes'] = ModelChangeLog.diff(previous, data)
+                previous = data
+
+        if not paginate:
+            return Response(logs_by_date, status=status.HTTP_200_OK)
+        next_link = None
+        if len(logs_by_date) > limit:
+            logs_by_date = logs_by_date[:limit]
+            url = request.build_absolute_uri()
+            next_link = replace_query_param(url, 'after', logs_by_date[-1]['id'])
+        return Response({'results': logs_by_date, 'next': next_link}, status=status.HTTP_200_OK)
+
+
+class ModelChangeLogSearch(generics.ListAPIView):
+    """
+    get:
+    Search the log entries of a table by their data.
 
-        return Response(logs_by_date, status=status.HTTP_200_OK)
+    contains: a JSON object the data must contain, e.g. {"ipaddresses": ["10.0.0.1"]}
+    to find the hosts with that ipaddress.
+    at: optional time. If given, only the entry which was the latest for
+    each object at that time is considered.
+    """
+    queryset = ModelChangeLog.objects.all()
+    serializer_class = ModelChangeLogSerializer
+
+    def get_queryset(self):
+        params = self.request.query_params
+        try:
+            contains = json.loads(params.get('contains', ''))
+        except ValueError:
+            raise ParseError(detail='contains must be a JSON object')
+        if not isinstance(contains, dict) or not contains:
+            raise ParseError(detail='contains must be a JSON object')
+        at = params.get('at')
+        if at is not None:
+            try:
+                at = parse_datetime(at)
+            except ValueError as error:
+                raise ParseError(detail=str(error))
+            if at is None:
+                raise ParseError(detail='at must be a datetime')
+            if timezone.is_naive(at):
+                at = timezone.make_aware(at)
+        return ModelChangeLog.search(self.kwargs['table'], contains, at=at)
 
 
 def _get_iprange(kwargs):
@@ -895,9 +1079,7 @@ def _get_iprange(kwargs):
 
 def _get_ips_by_range(iprange):
     network = ipaddress.ip_network(iprange)
-    from_ip = str(network.network_address)
-    to_ip = str(network.broadcast_address)
-    return Ipaddress.objects.filter(ipaddress__range=(from_ip, to_ip))
+    return Ipaddress.objects.filter(ipaddress__net_contained_or_equal=network)
 
 
 def _dhcphosts_by_range(iprange):
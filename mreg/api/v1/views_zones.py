@@ -1,25 +1,29 @@
 import django.core.exceptions
 
+from django.conf import settings
 from django.db import transaction
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
 
 from rest_framework import (generics, renderers, status)
 from rest_framework.decorators import api_view
 from rest_framework.exceptions import MethodNotAllowed, ParseError
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
 from url_filter.filtersets import ModelFilterSet
 
 from mreg.models import (ForwardZone, ForwardZoneDelegation,
                          Host, NameServer,
-                         ReverseZone, ReverseZoneDelegation)
+                         ReverseZone, ReverseZoneDelegation, ZoneJournal)
 from mreg.api.permissions import (IsSuperGroupMember, IsAuthenticatedAndReadOnly)
 
 from .serializers import (ForwardZoneDelegationSerializer, ForwardZoneSerializer,
                           ReverseZoneDelegationSerializer, ReverseZoneSerializer)
 from .views import (MregRetrieveUpdateDestroyAPIView, )
-from .zonefile import ZoneFile
+from .zonefile import ZoneFile, commit_zone, export_zonefiles
 
 
 class ForwardZoneFilterSet(ModelFilterSet):
@@ -332,20 +336,31 @@ def forward_zone_by_hostname(request, *args, **kwargs):
     Note the hostname does not need to exist as a Host.
     """
     hostname = kwargs['hostname'].lower()
-    zone = ForwardZone.get_zone_by_hostname(hostname)
-    if zone is None:
+    found = ForwardZone.get_zone_and_delegation_ids(hostname)
+    if found is None:
         raise Http404
-    if zone.name != hostname and zone.delegations.exists():
-        for delegation in zone.delegations.all():
-            if hostname == delegation.name or hostname.endswith(f".{delegation.name}"):
-                serializer = ForwardZoneDelegationSerializer(delegation)
-                ret = {"delegation": serializer.data}
-                return Response(ret, status=status.HTTP_200_OK)
+    zone_id, delegation_id = found
+    if delegation_id is not None:
+        delegation = get_object_or_404(ForwardZoneDelegation, id=delegation_id)
+        serializer = ForwardZoneDelegationSerializer(delegation)
+        ret = {"delegation": serializer.data}
+        return Response(ret, status=status.HTTP_200_OK)
+    zone = get_object_or_404(ForwardZone, id=zone_id)
     serializer = ForwardZoneSerializer(zone)
     ret = {"zone": serializer.data}
     return Response(ret, status=status.HTTP_200_OK)
 
 
+@api_view()
+def reverse_zone_multiple_ip_no_ptr(request, *args, **kwargs):
+    """
+    List ip addresses in the zone which are used by multiple hosts, but lack
+    a PtrOverride, and therefore get no PTR in the zonefile.
+    """
+    zone = get_object_or_404(ReverseZone, name=kwargs['name'])
+    return Response(list(zone.get_multiple_ip_no_ptr()), status=status.HTTP_200_OK)
+
+
 class PlainTextRenderer(renderers.TemplateHTMLRenderer):
     """
     Custom renderer used for outputting plaintext.
@@ -366,7 +381,12 @@ class ZoneFileDetail(generics.GenericAPIView):
     Handles a DNS zone file in plaintext.
 
     get:
-    Generate zonefile for a given zone.
+    Generate zonefile for a given zone. The zonefile is streamed to the
+    client while it is generated. This is a pure read, the serialno is
+    only updated by a commit or an export. Zones without pending changes are
+    served from a cache keyed on the zone's serialno. The response has an
+    ETag, and a request with a matching If-None-Match header gets
+    304 Not Modified without the zonefile being generated.
     """
 
     renderer_classes = (PlainTextRenderer, )
@@ -383,7 +403,95 @@ class ZoneFileDetail(generics.GenericAPIView):
 
     def get(self, request, *args, **kwargs):
         zone = self.get_object()
-        # XXX: a force argument to force serialno update?
-        zone.update_serialno()
         zonefile = ZoneFile(zone)
-        return Response(zonefile.generate())
+        response = get_conditional_response(request, etag=zonefile.etag)
+        if response is None:
+            response = StreamingHttpResponse(zonefile.stream_cached(),
+                                             content_type='text/plain; charset=utf-8')
+        response['ETag'] = zonefile.etag
+        return response
+
+
+class ZoneFileCommit(ZoneFileDetail):
+    """
+    Commits pending changes in a DNS zone.
+
+    post:
+    Update the serialno of the zone if it has changed since the serialno
+    was last updated. The serialno is updated at most once a minute, unless
+    "force" is set.
+    """
+
+    http_method_names = ['post', 'options']
+    permission_classes = (IsAuthenticated, )
+    renderer_classes = (JSONRenderer, )
+
+    def post(self, request, *args, **kwargs):
+        zone = self.get_object()
+        zone = commit_zone(zone, force=zone.updated and bool(request.data.get('force')))
+        ret = {'zone': zone.name,
+               'serialno': zone.serialno,
+               'updated': zone.updated}
+        return Response(ret, status=status.HTTP_200_OK)
+
+
+class ZoneFileDiff(ZoneFileDetail):
+    """
+    Handles incremental changes to a DNS zone.
+
+    get:
+    Returns the records removed and added in a zone from one serial number
+    to another, or to the current serial number if only one is given.
+    Changes are journaled whenever the serial number is updated, by a
+    commit or an export.
+    """
+
+    renderer_classes = (JSONRenderer, )
+
+    def get(self, request, *args, **kwargs):
+        zone = self.get_object()
+        from_serial = int(kwargs['from_serial'])
+        to_serial = kwargs.get('to_serial')
+        to_serial = zone.serialno if to_serial is None else int(to_serial)
+        if from_serial > to_serial:
+            raise ParseError(detail=f'Serial {from_serial} is newer than {to_serial}')
+        changes = ZoneJournal.get_changes(zone.name, from_serial, to_serial)
+        if changes is None:
+            content = {'ERROR': f'No journal for {zone.name} from serial {from_serial} '
+                                f'to {to_serial}, use the full zonefile'}
+            return Response(content, status=status.HTTP_404_NOT_FOUND)
+        removed, added = changes
+        ret = {'zone': zone.name,
+               'from_serial': from_serial,
+               'to_serial': to_serial,
+               'removed': sorted(removed),
+               'added': sorted(added)}
+        return Response(ret, status=status.HTTP_200_OK)
+
+
+class ZoneFileExport(generics.GenericAPIView):
+    """
+    Exports zonefiles to the directory in settings.ZONEFILE_EXPORT_DIR.
+
+    post:
+    Write zonefiles for all zones with pending changes. Zones whose records
+    are unchanged since the last export keep their serialno and file, and
+    zones which kept changing while exported are listed as "busy". Use the
+    export_zonefiles command to render the zones in parallel.
+    """
+
+    permission_classes = (IsSuperGroupMember, )
+    renderer_classes = (JSONRenderer, )
+    # Each zone is exported in its own transaction, so the export must not
+    # hold a transaction, and its locks, open for every zone.
+    batch_changes = False
+
+    def post(self, request, *args, **kwargs):
+        outdir = getattr(settings, 'ZONEFILE_EXPORT_DIR', None)
+        if outdir is None:
+            content = {'ERROR': 'ZONEFILE_EXPORT_DIR is not configured'}
+            return Response(content, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        ret = {'exported': [], 'unchanged': []}
+        for name, result in export_zonefiles(outdir):
+            ret.setdefault(result, []).append(name)
+        return Response(ret, status=status.HTTP_200_OK)
@@ -1,12 +1,27 @@
+import hashlib
 import ipaddress
+import os
+import re
+import tempfile
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-from mreg.models import Cname, ForwardZone, Hinfo, Host, Ipaddress, Loc, Mx, Naptr, Srv, Sshfp, Txt
-from mreg.utils import idna_encode, qualify
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, connections, transaction
+from django.utils import timezone
+
+from mreg.models import (Cname, ForwardZone, Hinfo, Host, Ipaddress, Loc, Mx,
+                         Naptr, ReverseZone, Srv, Sshfp, Txt, ZoneJournal,
+                         ZoneSnapshot)
+from mreg.utils import NameEncoder, create_serialno
 
 
 class ZoneFile:
     def __init__(self, zone):
+        self.zone = zone
         if zone.name.endswith('.in-addr.arpa'):
             self.zonetype = IPv4ReverseFile(zone)
         elif zone.name.endswith('.ip6.arpa'):
@@ -17,13 +32,315 @@ class ZoneFile:
     def generate(self):
         return self.zonetype.generate()
 
+    def stream(self, chunk_size=65536):
+        """Yield the zonefile in chunks of roughly chunk_size characters."""
+        buf = []
+        size = 0
+        for data in self.zonetype.stream():
+            buf.append(data)
+            size += len(data)
+            if size >= chunk_size:
+                yield "".join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield "".join(buf)
+
+    @property
+    def etag(self):
+        """Strong ETag for the zone's current content, given by the serial
+        number and the time of the last change to the zone."""
+        zone = self.zone
+        updated_at = int(zone.updated_at.timestamp() * 1000000)
+        return f'"{zone.id}-{zone.serialno}-{updated_at}"'
+
+    def stream_cached(self):
+        """Like stream(), but use the zonefile cache when the zone has no
+        pending changes, i.e. when its content is given by its serialno."""
+        if self.zone.updated:
+            yield from self.stream()
+            return
+        key = zonefile_cache_key(self.zone)
+        data = cache.get(key)
+        if data is not None:
+            yield data
+            return
+        # Zonefiles too large to cache are only streamed, and not kept in
+        # memory while streamed.
+        max_size = getattr(settings, 'ZONEFILE_CACHE_MAX_SIZE', None)
+        chunks = []
+        size = 0
+        for chunk in self.stream():
+            if chunks is not None:
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is None:
+            return
+        data = "".join(chunks)
+        timeout = getattr(settings, 'ZONEFILE_CACHE_TIMEOUT', 86400)
+        cache.set(key, data, timeout)
+
+
+def zonefile_cache_key(zone):
+    return f'zonefile:{zone.name}:{zone.id}:{zone.serialno}'
+
+
+def invalidate_zonefile_cache(zone):
+    cache.delete(zonefile_cache_key(zone))
+
+
+_token_re = re.compile(r'"(?:[^"\\]|\\.)*"|\S+')
+
+
+def get_records(data):
+    """Returns the set of resource records in a generated zonefile, with
+    absolute owner names and the SOA record left out."""
+    records = set()
+    origin = owner = ''
+    lines = iter(data.splitlines())
+    for line in lines:
+        if not line.strip() or line.startswith((';', 'OPS:')):
+            continue
+        tokens = _token_re.findall(line)
+        if tokens[0] == '$ORIGIN':
+            origin = tokens[1]
+            continue
+        elif tokens[0].startswith('$'):
+            continue
+        if not line[0].isspace():
+            owner = tokens.pop(0)
+            if owner == '@':
+                owner = origin
+            elif not owner.endswith('.'):
+                owner = f'{owner}.{origin}'
+        if 'SOA' in tokens[:3]:
+            while ')' not in line:
+                line = next(lines)
+            continue
+        records.add(' '.join([owner] + tokens))
+    return records
+
+
+def update_journal(zone, data):
+    """Journal the records changed in zone since the last journaled serial
+    number. data is the zonefile at the zone's current serial number."""
+    try:
+        with transaction.atomic():
+            snapshot = ZoneSnapshot.objects.select_for_update().filter(zone=zone.name).first()
+            if snapshot is None:
+                snapshot = ZoneSnapshot(zone=zone.name)
+            elif snapshot.serialno == zone.serialno:
+                return
+            records = get_records(data)
+            if snapshot.id is not None and snapshot.serialno < zone.serialno:
+                old_records = set(snapshot.records.splitlines())
+                ZoneJournal.objects.create(zone=zone.name,
+                                           from_serial=snapshot.serialno,
+                                           to_serial=zone.serialno,
+                                           removed="\n".join(sorted(old_records - records)),
+                                           added="\n".join(sorted(records - old_records)))
+            snapshot.serialno = zone.serialno
+            snapshot.records = "\n".join(sorted(records))
+            snapshot.save()
+    except IntegrityError:
+        # Another request journaled this serial number at the same time.
+        pass
+
+
+def _commit_locked(zone, force, data):
+    old_serialno = zone.serialno
+    zone.update_serialno(force=force)
+    # The serialno is left as is when the day's serial numbers are used up,
+    # or the zone could not be saved.
+    zone.refresh_from_db(fields=['serialno'])
+    if zone.serialno != old_serialno:
+        update_journal(zone, data)
+    return zone
+
+
+def commit_zone(zone, force=False, attempts=3):
+    """Update the serialno of a zone with pending changes, as done by
+    BaseZone.update_serialno(), and journal the changes at the new serial
+    number in the same transaction. The zone is rendered before its row is
+    locked, so changes to the zone are not blocked while it is rendered, and
+    rendered again if it was changed meanwhile. If it keeps changing, the
+    last attempt is rendered while locked. Returns the zone as committed."""
+    model = type(zone)
+    for _ in range(attempts):
+        zone = model.objects.get(id=zone.id)
+        if not zone.serialno_update_due(force=force):
+            return zone
+        data = ZoneFile(zone).generate()
+        rendered = (zone.updated_at, zone.serialno)
+        with transaction.atomic():
+            zone = model.objects.select_for_update().get(id=zone.id)
+            if (zone.updated_at, zone.serialno) == rendered:
+                return _commit_locked(zone, force, data)
+    with transaction.atomic():
+        zone = model.objects.select_for_update().get(id=zone.id)
+        return _commit_locked(zone, force, ZoneFile(zone).generate())
+
+
+def records_hash(data):
+    """Hash of the records in a zonefile, which ignores the SOA record and
+    comments, so it only changes when the zone content changes."""
+    records = "\n".join(sorted(get_records(data)))
+    return hashlib.sha256(records.encode()).hexdigest()
+
+
+def _write_atomic(path, data):
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.zonefile')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def _is_parallel(zone):
+    """True if the zone is rendered in parallel when exported with an
+    executor, which is only for IPv4 reverse zones larger than a /24."""
+    return isinstance(zone, ReverseZone) and zone.network.version == 4 \
+        and zone.network.prefixlen < 24
+
+
+_worker_ready = False
+
+
+def _in_worker(func, args):
+    """Run func(args) in an export worker, setting up Django first if the
+    process has not done so. ProcessPoolExecutor only takes an initializer
+    from Python 3.7."""
+    global _worker_ready
+    if not _worker_ready:
+        django.setup()
+        _worker_ready = True
+    return func(args)
+
+
+def start_export_workers(workers=None):
+    """Returns a process pool for export_zonefiles(). The processes are
+    forked right away, with every database connection closed, as they must
+    not share the connections of this process."""
+    connections.close_all()
+    executor = ProcessPoolExecutor(max_workers=workers)
+    # The first task starts all of the processes.
+    executor.submit(int).result()
+    return executor
+
+
+def _export_zone(args, executor=None, chunks=None):
+    """Write the zonefile for a zone with pending changes to outdir. The
+    serialno is only updated if the zone content has changed. The zone is
+    rendered again if it was changed while rendered, and left as 'busy' if
+    it keeps changing. A large IPv4 reverse zone is rendered by executor's
+    processes in about chunks parts, if given."""
+    model, zone_id, outdir, attempts = args
+    for _ in range(attempts):
+        zone = model.objects.get(id=zone_id)
+        path = os.path.join(outdir, zone.name.replace('/', '-'))
+        header = zone.zf_string
+        if executor is not None and _is_parallel(zone):
+            data = IPv4ReverseFile(zone).generate_parallel(executor, chunks)
+        else:
+            data = ZoneFile(zone).generate()
+        try:
+            with open(path, encoding='utf-8') as f:
+                old_hash = records_hash(f.read())
+        except FileNotFoundError:
+            old_hash = None
+        # Only update the zone if it was not changed after it was read.
+        unchanged_zone = model.objects.filter(id=zone.id, updated_at=zone.updated_at)
+        if old_hash == records_hash(data):
+            if unchanged_zone.update(updated=False):
+                return zone.name, 'unchanged'
+            continue
+        with transaction.atomic():
+            old_serialno = zone.serialno
+            zone.serialno = create_serialno(zone.serialno)
+            zone.serialno_updated_at = timezone.now()
+            zone.updated = False
+            if not unchanged_zone.update(serialno=zone.serialno,
+                                         serialno_updated_at=zone.serialno_updated_at,
+                                         updated=False):
+                continue
+            data = zone.zf_string + data[len(header):]
+            # Not journaled when the day's serial numbers are used up.
+            if zone.serialno != old_serialno:
+                update_journal(zone, data)
+            _write_atomic(path, data)
+        return zone.name, 'exported'
+    return zone.name, 'busy'
+
+
+def export_zonefiles(outdir, executor=None, attempts=3, chunks=16):
+    """Export every zone with pending changes to outdir, rendering the zones
+    in parallel in executor's processes if given. Large IPv4 reverse zones
+    are split in about chunks ranges of /24s, rendered in parallel. Returns
+    a list of the zone names and whether the zone was exported, unchanged
+    or busy."""
+    tasks = []
+    parallel = []
+    for model in (ForwardZone, ReverseZone):
+        for zone in model.objects.filter(updated=True):
+            task = (model, zone.id, outdir, attempts)
+            if executor is not None and _is_parallel(zone):
+                parallel.append(task)
+            else:
+                tasks.append(task)
+    if executor is None:
+        return [_export_zone(task) for task in tasks]
+    results = executor.map(partial(_in_worker, _export_zone), tasks)
+    # The workers can not use the executor, so the zones rendered in parallel
+    # are exported from this process.
+    ret = [_export_zone(task, executor=executor, chunks=chunks) for task in parallel]
+    return list(results) + ret
+
 
 class Common:
 
     def __init__(self, zone):
         self.zone = zone
+        self.names = NameEncoder(zone.name)
         self.glue_done = set()
 
+    def cache_glue(self, subs):
+        """Look up the hosts and ip addresses of every in-zone nameserver
+        used by subs, the delegations and subdomains of the zone."""
+        names = set()
+        for sub in subs:
+            for ns in sub.nameservers.all():
+                if ns.name.endswith("." + self.zone.name):
+                    names.add(ns.name)
+        self.glue_hosts = dict()
+        self.glue_ips = defaultdict(list)
+        if not names:
+            return
+        hosts = Host.objects.filter(name__in=names)
+        for name, ttl, zone_id in hosts.values_list('name', 'ttl', 'zone'):
+            self.glue_hosts[name] = (ttl, zone_id)
+        ips = Ipaddress.objects.filter(host__name__in=names).order_by('id')
+        for name, ip in ips.values_list('host__name', 'ipaddress'):
+            self.glue_ips[name].append(ip)
+
+    def cache_nameservers(self):
+        self.delegations = list(self.zone.delegations.all().order_by("name")
+                                .prefetch_related("nameservers"))
+        self.subzones = list(self.get_subzones().prefetch_related("nameservers"))
+        self.cache_glue(self.delegations + self.subzones)
+
+    def get_subzones(self):
+        return ForwardZone.objects.none()
+
     def get_glue(self, ns):
         """Returns glue for a nameserver. If already used return blank"""
         if ns in self.glue_done:
@@ -32,53 +349,59 @@ class Common:
             self.glue_done.add(ns)
         if not ns.endswith("." + self.zone.name):
             return ""
-        try:
-            host = Host.objects.get(name=ns)
-        except Host.DoesNotExist:
+        if ns not in self.glue_hosts:
             # XXX: signal hostmaster?
             return f"OPS: missing glue for {ns}\n"
-        if not host.ipaddresses.exists():
+        if not self.glue_ips[ns]:
             # XXX: signal hostmaster?
             return f"OPS: no ipaddress for name server {ns}\n"
         # self's name servers do not need glue, as they will come later
         # in the zonefile.
-        if host.zone == self.zone:
+        host_ttl, host_zone_id = self.glue_hosts[ns]
+        if isinstance(self.zone, ForwardZone) and host_zone_id == self.zone.id:
             return ""
         data = ""
-        idna_name = 'f{idna_encode(qualify(host.name, self.zone.name)):24}'
-        ttl = prep_ttl(host.ttl)
-        for ip in host.ipaddresses.all():
-            ipaddr = ipaddress.ip_address(ip.ipaddress)
+        idna_name = f'{self.names.encode(ns):24}'
+        ttl = prep_ttl(host_ttl)
+        for ip in self.glue_ips[ns]:
+            ipaddr = ipaddress.ip_address(ip)
             record_type = 'A     ' if ipaddr.version == 4 else 'AAAA  '
-            data += self.ip_zf_string(idna_name, ttl, record_type, ip.ipaddress)
+            data += self.ip_zf_string(idna_name, ttl, record_type, ip)
         return data
 
-    def get_ns_data(self, qs):
-        data = ""
-        qs = qs.prefetch_related("nameservers")
-        for sub in qs:
+    def ip_zf_string(self, name, ttl, record_type, record_data):
+        return f'{name} {ttl} IN {record_type} {record_data}\n'
+
+    def get_ns_data(self, subs):
+        for sub in subs:
             nameservers = sub.nameservers.all()
-            if not nameservers.exists():
+            if not nameservers:
                 # XXX What to do?
-                return f"OPS: NO NS FOR {sub.name}\n"
+                yield f"OPS: NO NS FOR {sub.name}\n"
+                return
             for ns in nameservers:
-                data += ns.zf_string(self.zone.name, subzone=sub.name)
-                data += self.get_glue(ns.name)
-        return data
+                yield ns.zf_string(self.zone.name, subzone=sub.name, encoder=self.names)
+                yield self.get_glue(ns.name)
 
     def get_delegations(self):
-        data = ""
-        delegations = self.zone.delegations.all().order_by("name")
-        if delegations:
-            data += self.get_ns_data(delegations)
-            data = ';\n; Delegations\n;\n' + data
-        return data
+        if self.delegations:
+            yield ';\n; Delegations\n;\n'
+            yield from self.get_ns_data(self.delegations)
 
+    def get_header(self):
+        zone = self.zone
+        self.cache_nameservers()
+        yield zone.zf_string
+        yield ';\n; Name servers\n;\n'
+        for ns in zone.nameservers.all():
+            yield ns.zf_string(zone.name, encoder=self.names)
+        yield from self.get_delegations()
 
-class ForwardFile(Common):
+    def generate(self):
+        return "".join(self.stream())
 
-    def ip_zf_string(self, name, ttl, record_type, record_data):
-        return f'{name} {ttl} IN {record_type} {record_data}\n'
+
+class ForwardFile(Common):
 
     def loc_zf_string(self, name, ttl, loc):
         record_type = 'LOC   '
@@ -90,7 +413,7 @@ class ForwardFile(Common):
             'ttl': ttl,
             'record_type': "MX",
             'priority': priority,
-            'mx': idna_encode(qualify(mx, self.zone.name))
+            'mx': self.names.encode(mx)
         }
         return '{name} {ttl} IN {record_type} {priority:6} {mx}\n'.format_map(data)
 
@@ -114,7 +437,7 @@ class ForwardFile(Common):
     def naptr_zf_string(self, name, ttl, preference, order, flag, service, regex, replacement):
         """String representation for zonefile export."""
         if flag in ('a', 's'):
-            replacement = idna_encode(qualify(replacement, self.zone.name))
+            replacement = self.names.encode(replacement)
 
         data = {
             'name': name,
@@ -133,7 +456,7 @@ class ForwardFile(Common):
     def srv_zf_string(self, name, ttl, priority, weight, port, target):
         """String representation for zonefile export."""
         data = {
-            'name': idna_encode(qualify(name, self.zone.name)),
+            'name': self.names.encode(name),
             'ttl': prep_ttl(ttl),
             'record_type': 'SRV   ',
             'priority': priority,
@@ -146,7 +469,7 @@ class ForwardFile(Common):
     def cname_zf_string(self, alias, ttl, target):
         """String representation for zonefile export."""
         data = {
-            'alias': idna_encode(qualify(alias, self.zone.name)),
+            'alias': self.names.encode(alias),
             'ttl': prep_ttl(ttl),
             'record_type': 'CNAME ',
             'record_data': target,
@@ -162,7 +485,7 @@ class ForwardFile(Common):
 
     def host_data(self, host):
         data = ""
-        idna_name = idna_encode(qualify(host.name, self.zone.name))
+        idna_name = self.names.encode(host.name)
         name = f'{idna_name:24}'
         ttl = prep_ttl(host.ttl)
         for values, func in ((self.ipaddresses, self.ip_zf_string),
@@ -217,7 +540,7 @@ class ForwardFile(Common):
         ips = Ipaddress.objects.filter(host__zone=self.zone)
         for network, record_type in (('0.0.0.0/0', 'A     '),
                                      ('::/0', 'AAAA  '),):
-            ipfilter = ips.extra(where=["ipaddress << %s"], params=[network])
+            ipfilter = ips.filter(ipaddress__net_contained_or_equal=network)
             for hostname, ip in ipfilter.values_list("host__name", "ipaddress"):
                 self.ipaddresses[hostname].append((record_type, ip,))
 
@@ -246,96 +569,122 @@ class ForwardFile(Common):
         for hostname, txt in txts.values_list("host__name", "txt"):
             self.txts[hostname].append((txt,))
 
+    def get_subzones(self):
+        return ForwardZone.objects.filter(name__endswith="." + self.zone.name).order_by("name")
+
     def get_subdomains(self):
-        data = ""
-        subzones = ForwardZone.objects.filter(name__endswith="." + self.zone.name)
-        if subzones:
-            data += self.get_ns_data(subzones.order_by("name"))
-            data = ';\n; Subdomains\n;\n' + data
-        return data
+        if self.subzones:
+            yield ';\n; Subdomains\n;\n'
+            yield from self.get_ns_data(self.subzones)
 
-    def generate(self):
+    def stream(self):
         zone = self.zone
         self.cache_hostdata()
         # Print info about Zone and its nameservers
-        data = zone.zf_string
-        data += ';\n; Name servers\n;\n'
-        for ns in zone.nameservers.all():
-            data += ns.zf_string(zone.name)
-
-        data += self.get_delegations()
-        data += self.get_subdomains()
+        yield from self.get_header()
+        yield from self.get_subdomains()
         try:
             root = Host.objects.get(name=zone.name)
             root_data = self.host_data(root)
             if root_data:
-                data += ";\n"
-                data += "@" + root_data
-                data += ";\n"
+                yield ";\n"
+                yield "@" + root_data
+                yield ";\n"
         except Host.DoesNotExist:
             pass
         # Print info about hosts and their corresponding data
         hosts = Host.objects.filter(zone=zone.id).order_by('name')
         hosts = hosts.exclude(name=zone.name)
-        if hosts:
-            data += ';\n; Host addresses\n;\n'
-            for host in hosts:
-                data += self.host_data(host)
+        if hosts.exists():
+            yield ';\n; Host addresses\n;\n'
+            for host in hosts.iterator():
+                yield self.host_data(host)
         # Print misc entries
         srvs = Srv.objects.filter(zone=zone.id).exclude(host__zone=zone.id)
-        if srvs:
-            data += ';\n; Services pointing out of the zone\n;\n'
+        if srvs.exists():
+            yield ';\n; Services pointing out of the zone\n;\n'
             for i in srvs.values_list('name', 'ttl', 'priority', 'weight', 'port', 'host__name'):
-                host = idna_encode(qualify(i[-1], self.zone.name))
-                data += self.srv_zf_string(*i[:-1], host)
+                host = self.names.encode(i[-1])
+                yield self.srv_zf_string(*i[:-1], host)
         cnames = Cname.objects.filter(zone=zone.id).exclude(host__zone=zone.id)
-        if cnames:
-            data += ';\n; Cnames pointing out of the zone\n;\n'
+        if cnames.exists():
+            yield ';\n; Cnames pointing out of the zone\n;\n'
             for i in cnames.values_list('name', 'ttl', 'host__name'):
-                host = idna_encode(qualify(i[-1], self.zone.name))
-                data += self.cname_zf_string(*i[:-1], host)
-        return data
+                host = self.names.encode(i[-1])
+                yield self.cname_zf_string(*i[:-1], host)
+
+
+def _export_snapshot():
+    """Start a repeatable read transaction, which must be the outermost
+    atomic block, and return its snapshot for other processes to import."""
+    with connection.cursor() as cursor:
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cursor.execute('SELECT pg_export_snapshot()')
+        return cursor.fetchone()[0]
+
+
+def _render_ipv4_reverse_chunk(args):
+    """Worker: render the PTRs of a zone within a network, as seen in the
+    exported snapshot."""
+    snapshot, zone_id, network = args
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', [snapshot])
+        zone = ReverseZone.objects.get(id=zone_id)
+        return "".join(IPv4ReverseFile(zone).get_ptrs(network))
 
 
 class IPv4ReverseFile(Common):
 
-    def generate(self):
-        zone = self.zone
-        data = zone.zf_string
-        data += ';\n; Name servers\n;\n'
-        for ns in zone.nameservers.all():
-            data += ns.zf_string(zone.name)
-        data += self.get_delegations()
+    def get_chunks(self, count):
+        """Split the zone in count networks, rounded up to a power of two,
+        but not smaller than a /24. Each /24 has its own $ORIGIN, so the
+        chunks can be rendered independently."""
+        network = self.zone.network
+        prefixlen = network.prefixlen + (max(count, 1) - 1).bit_length()
+        return list(network.subnets(new_prefix=max(network.prefixlen, min(prefixlen, 24))))
+
+    def stream(self):
+        yield from self.get_header()
+        yield from self.get_ptrs()
+
+    def generate_parallel(self, executor, chunks=16):
+        """Generate the zonefile, with the PTRs split in about chunks parts
+        rendered by executor's processes. All of them read the same snapshot
+        of the database, so must be called outside of any transaction."""
+        with transaction.atomic():
+            snapshot = _export_snapshot()
+            header = "".join(self.get_header())
+            tasks = [(snapshot, self.zone.id, network) for network in self.get_chunks(chunks)]
+            render = partial(_in_worker, _render_ipv4_reverse_chunk)
+            return header + "".join(executor.map(render, tasks))
+
+    def get_ptrs(self, network=None):
         _prev_net = 'z'
-        for ip, ttl, hostname in zone.get_ipaddresses():
+        for ip, ttl, hostname in self.zone.iter_ipaddresses(network=network):
             rev = ip.reverse_pointer
             # Add $ORIGIN between every new /24 found
             if not rev.endswith(_prev_net):
                 _prev_net = rev[rev.find('.'):]
-                data += "$ORIGIN {}.\n".format(_prev_net[1::])
+                yield "$ORIGIN {}.\n".format(_prev_net[1::])
             ptrip = rev[:rev.find('.')]
-            data += "{} {}\tPTR\t{}.\n".format(ptrip, ttl, idna_encode(hostname))
-        return data
+            yield "{} {}\tPTR\t{}.\n".format(ptrip, ttl, self.names.idna_encode(hostname))
 
 
 class IPv6ReverseFile(Common):
 
-    def generate(self):
+    def stream(self):
         zone = self.zone
-        data = zone.zf_string
-        data += ';\n; Name servers\n;\n'
-        for ns in zone.nameservers.all():
-            data += ns.zf_string(zone.name)
-        data += self.get_delegations()
+        yield from self.get_header()
         _prev_net = 'z'
-        for ip, ttl, hostname in zone.get_ipaddresses():
+        for ip, ttl, hostname in zone.iter_ipaddresses():
             rev = ip.reverse_pointer
             # Add $ORIGIN between every new /64 found
             if not rev.endswith(_prev_net):
                 _prev_net = rev[32:]
-                data += "$ORIGIN {}.\n".format(_prev_net)
-            data += "{} {}\tPTR\t{}.\n".format(rev[:31], ttl, idna_encode(hostname))
-        return data
+                yield "$ORIGIN {}.\n".format(_prev_net)
+            yield "{} {}\tPTR\t{}.\n".format(rev[:31], ttl, self.names.idna_encode(hostname))
 
 
 def prep_ttl(ttl):
@@ -1,4 +1,5 @@
 import django.contrib.postgres.fields as pgfields
+from django.db.models import GenericIPAddressField, Lookup
 
 from .validators import validate_hostname
 
@@ -23,3 +24,24 @@ class DnsNameField(LCICharField):
         if 'validators' not in kwargs:
             kwargs['validators'] = [validate_hostname]
         super().__init__(*args, **kwargs)
+
+
+@GenericIPAddressField.register_lookup
+class NetContainedOrEqual(Lookup):
+    """
+    Matches ip addresses within a network, e.g.
+    Ipaddress.objects.filter(ipaddress__net_contained_or_equal='10.0.0.0/24').
+
+    Uses the inet <<= operator, which can use a GiST index with inet_ops.
+    """
+    lookup_name = 'net_contained_or_equal'
+    prepare_rhs = False
+
+    def get_prep_lookup(self):
+        # A network is not a valid GenericIPAddressField value.
+        return str(self.rhs)
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} <<= {rhs}::inet', lhs_params + rhs_params
@@ -0,0 +1,27 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from mreg.api.v1.zonefile import export_zonefiles, start_export_workers
+
+
+class Command(BaseCommand):
+    help = 'Export zonefiles for all zones with pending changes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('outdir', help='Directory to write the zonefiles to')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker processes. Default is one per CPU')
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or os.cpu_count() or 1
+        if workers == 1:
+            results = export_zonefiles(options['outdir'])
+        else:
+            with start_export_workers(workers) as executor:
+                # A few chunks per worker evens out the work, without
+                # paying the setup of a transaction for every /24.
+                results = export_zonefiles(options['outdir'], executor=executor,
+                                           chunks=4 * workers)
+        for name, status in results:
+            self.stdout.write(f'{name}: {status}')
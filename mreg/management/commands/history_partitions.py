@@ -0,0 +1,65 @@
+import gzip
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from mreg.models import ModelChangeLog
+
+
+def archive_partition(month, archive_dir):
+    """Write the entries of a partition, as JSON lines, to a gzipped file
+    in archive_dir. Returns the path of the file."""
+    name = ModelChangeLog.partition_name(month)
+    path = os.path.join(archive_dir, f'{name}.jsonl.gz')
+    fd, tmp = tempfile.mkstemp(dir=archive_dir, prefix=f'.{name}.')
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.open(raw, 'wt') as f:
+                entries = ModelChangeLog.get_partition_entries(month).order_by('id').values()
+                for entry in entries.iterator(chunk_size=2000):
+                    f.write(json.dumps(entry, cls=DjangoJSONEncoder) + '\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return path
+
+
+class Command(BaseCommand):
+    help = 'Create the monthly history partitions, and archive and drop the expired ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=2,
+                            help='Create partitions for this many months after the current one')
+        parser.add_argument('--keep-months', type=int,
+                            help='Archive and drop the partitions older than this many months. '
+                                 'Nothing is dropped if not given')
+        parser.add_argument('--archive-dir',
+                            help='Directory for the archives of the dropped partitions')
+
+    def handle(self, *args, **options):
+        keep_months = options['keep_months']
+        archive_dir = options['archive_dir']
+        if keep_months is not None:
+            if archive_dir is None:
+                raise CommandError('--keep-months requires --archive-dir')
+            if keep_months < 0:
+                raise CommandError('--keep-months must not be negative')
+
+        for month in ModelChangeLog.split_default_partition():
+            self.stdout.write(f'Moved entries from the default partition to '
+                              f'{ModelChangeLog.partition_name(month)}')
+        for month in ModelChangeLog.ensure_partitions(options['months_ahead']):
+            self.stdout.write(f'Created {ModelChangeLog.partition_name(month)}')
+
+        if keep_months is None:
+            return
+        for month in ModelChangeLog.get_expired_partitions(keep_months):
+            path = archive_partition(month, archive_dir)
+            ModelChangeLog.drop_partition(month)
+            self.stdout.write(f'Archived {ModelChangeLog.partition_name(month)} to {path} and dropped it')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from mreg.api.v1.zonefile import commit_zone
+from mreg.models import ForwardZone, ReverseZone
+
+
+class Command(BaseCommand):
+    help = 'Update the serialno of all zones with pending changes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Update even if the serialno was updated less than a minute ago')
+
+    def handle(self, *args, **options):
+        for model in (ForwardZone, ReverseZone):
+            for zone in model.objects.filter(updated=True):
+                old_serialno = zone.serialno
+                zone = commit_zone(zone, force=options['force'])
+                if zone.serialno != old_serialno:
+                    self.stdout.write(f'{zone.name}: {old_serialno} -> {zone.serialno}')
@@ -0,0 +1,34 @@
+from django.urls import Resolver404, resolve
+
+from mreg.signals import batch_changes
+
+
+class BatchChangesMiddleware:
+    """
+    Runs every request which may change data in a batch_changes() block, so
+    the zones it changed are marked as updated, and the hosts it changed
+    logged, once, in the transaction of the request.
+
+    A view which must not run in a single transaction, e.g. as it writes
+    files or runs for long, opts out by setting batch_changes to False.
+    """
+
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method in self.safe_methods or not self.view_batches_changes(request):
+            return self.get_response(request)
+        with batch_changes():
+            return self.get_response(request)
+
+    @staticmethod
+    def view_batches_changes(request):
+        try:
+            view = resolve(request.path_info).func
+        except Resolver404:
+            return False
+        view = getattr(view, 'view_class', view)
+        return getattr(view, 'batch_changes', True)
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+import mreg.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ZoneSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zone', mreg.fields.LCICharField(max_length=253, unique=True)),
+                ('serialno', models.BigIntegerField()),
+                ('records', models.TextField()),
+            ],
+            options={
+                'db_table': 'zone_snapshot',
+            },
+        ),
+        migrations.CreateModel(
+            name='ZoneJournal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zone', mreg.fields.LCICharField(max_length=253)),
+                ('from_serial', models.BigIntegerField()),
+                ('to_serial', models.BigIntegerField()),
+                ('removed', models.TextField(blank=True)),
+                ('added', models.TextField(blank=True)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'zone_journal',
+                'unique_together': {('zone', 'from_serial')},
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0002_zonejournal_zonesnapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ipaddress',
+            name='ipaddress',
+            field=models.GenericIPAddressField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0003_ipaddress_ipaddress_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ipaddress',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['ipaddress'], name='ipaddress_ipaddress_gist', opclasses=['inet_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='ptroverride',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['ipaddress'], name='ptr_override_ipaddress_gist', opclasses=['inet_ops']),
+        ),
+    ]
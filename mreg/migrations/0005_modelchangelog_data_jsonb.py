@@ -0,0 +1,128 @@
+import ast
+import datetime
+import decimal
+import json
+import uuid
+
+import django.contrib.postgres.fields.jsonb
+import django.contrib.postgres.indexes
+import django.core.serializers.json
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 1000
+
+# Values saved by their constructor call in the repr of the data.
+_CONSTRUCTORS = {
+    'datetime.date': datetime.date,
+    'datetime.datetime': datetime.datetime,
+    'datetime.time': datetime.time,
+    'Decimal': decimal.Decimal,
+    'UUID': uuid.UUID,
+}
+
+
+def _call_name(func):
+    if isinstance(func, ast.Name):
+        return func.id
+    if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name):
+        return f'{func.value.id}.{func.attr}'
+    return None
+
+
+class _ReprToLiteral(ast.NodeTransformer):
+    """Nested serializer data was saved as OrderedDict([(key, value), ...]),
+    and dates, decimals and UUIDs as calls to their constructors. The latter
+    become the strings DjangoJSONEncoder gives them."""
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        name = _call_name(node.func)
+        if name == 'OrderedDict':
+            items = node.args[0].elts if node.args else []
+            return ast.Dict(keys=[i.elts[0] for i in items], values=[i.elts[1] for i in items])
+        if name in _CONSTRUCTORS:
+            args = [ast.literal_eval(arg) for arg in node.args]
+            kwargs = {kw.arg: ast.literal_eval(kw.value) for kw in node.keywords}
+            value = _CONSTRUCTORS[name](*args, **kwargs)
+            value = json.loads(json.dumps(value, cls=django.core.serializers.json.DjangoJSONEncoder))
+            return ast.copy_location(ast.Constant(value=value), node)
+        return node
+
+
+def _parse_repr(text):
+    """Returns the data of a history entry from the repr it was saved as.
+    Data which is not a literal after the conversions above, as a datetime
+    with a tzinfo, is kept as the text in {'unparsed': text}."""
+    try:
+        tree = _ReprToLiteral().visit(ast.parse(text, mode='eval'))
+        return ast.literal_eval(tree)
+    except (SyntaxError, ValueError, TypeError, AttributeError, IndexError,
+            decimal.InvalidOperation):
+        return {'unparsed': text}
+
+
+def _convert(apps, source, target, convert):
+    """Convert the entries in batches, each in its own transaction, as the
+    history can be too large for a single one."""
+    ModelChangeLog = apps.get_model('mreg', 'ModelChangeLog')
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            entries = ModelChangeLog.objects.filter(id__gt=last_id).order_by('id').only(source)
+            batch = list(entries[:BATCH_SIZE])
+            if not batch:
+                return
+            for entry in batch:
+                setattr(entry, target, convert(getattr(entry, source)))
+            ModelChangeLog.objects.bulk_update(batch, [target])
+        last_id = batch[-1].id
+
+
+def text_to_json(apps, schema_editor):
+    _convert(apps, 'data', 'data_json', _parse_repr)
+
+
+def json_to_text(apps, schema_editor):
+    _convert(apps, 'data_json', 'data', str)
+
+
+class Migration(migrations.Migration):
+
+    # The entries are converted in batches, see _convert().
+    atomic = False
+
+    dependencies = [
+        ('mreg', '0004_ipaddress_gist_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modelchangelog',
+            name='data_json',
+            field=django.contrib.postgres.fields.jsonb.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, null=True),
+        ),
+        migrations.AlterField(
+            model_name='modelchangelog',
+            name='data',
+            field=models.TextField(null=True),
+        ),
+        migrations.RunPython(text_to_json, json_to_text),
+        migrations.RemoveField(
+            model_name='modelchangelog',
+            name='data',
+        ),
+        migrations.RenameField(
+            model_name='modelchangelog',
+            old_name='data_json',
+            new_name='data',
+        ),
+        migrations.AlterField(
+            model_name='modelchangelog',
+            name='data',
+            field=django.contrib.postgres.fields.jsonb.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder),
+        ),
+        migrations.AddIndex(
+            model_name='modelchangelog',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['data'], name='model_change_log_data_gin'),
+        ),
+    ]
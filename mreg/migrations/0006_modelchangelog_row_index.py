@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0005_modelchangelog_data_jsonb'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='modelchangelog',
+            index=models.Index(fields=['table_name', 'table_row', 'timestamp'], name='model_change_log_row_idx'),
+        ),
+    ]
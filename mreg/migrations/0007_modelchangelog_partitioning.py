@@ -0,0 +1,58 @@
+from django.db import migrations
+
+# Partition model_change_log by month on timestamp. A partitioned table's
+# primary key must include the partition key, so it becomes (id, timestamp),
+# while id is still unique from its sequence. Partitions are created for the
+# months with entries up to next month, and the default partition takes any
+# entry outside of them. Later partitions are created by the
+# history_partitions management command.
+
+partition_sql = """
+CREATE TABLE model_change_log_new (LIKE model_change_log INCLUDING DEFAULTS)
+    PARTITION BY RANGE ("timestamp");
+ALTER TABLE model_change_log_new ADD PRIMARY KEY (id, "timestamp");
+CREATE TABLE model_change_log_default PARTITION OF model_change_log_new DEFAULT;
+DO $$
+DECLARE
+    month timestamptz;
+BEGIN
+    FOR month IN SELECT generate_series(
+            date_trunc('month', coalesce((SELECT min("timestamp") FROM model_change_log), now())),
+            date_trunc('month', now()) + interval '1 month',
+            interval '1 month')
+    LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF model_change_log_new FOR VALUES FROM (%L) TO (%L)',
+                       'model_change_log_' || to_char(month, 'YYYY_MM'), month, month + interval '1 month');
+    END LOOP;
+END $$;
+INSERT INTO model_change_log_new SELECT * FROM model_change_log;
+ALTER SEQUENCE model_change_log_id_seq OWNED BY model_change_log_new.id;
+DROP TABLE model_change_log;
+ALTER TABLE model_change_log_new RENAME TO model_change_log;
+ALTER TABLE model_change_log RENAME CONSTRAINT model_change_log_new_pkey TO model_change_log_pkey;
+CREATE INDEX model_change_log_data_gin ON model_change_log USING gin (data);
+CREATE INDEX model_change_log_row_idx ON model_change_log (table_name, table_row, "timestamp");
+"""
+
+unpartition_sql = """
+CREATE TABLE model_change_log_new (LIKE model_change_log INCLUDING DEFAULTS);
+INSERT INTO model_change_log_new SELECT * FROM model_change_log;
+ALTER TABLE model_change_log_new ADD PRIMARY KEY (id);
+ALTER SEQUENCE model_change_log_id_seq OWNED BY model_change_log_new.id;
+DROP TABLE model_change_log;
+ALTER TABLE model_change_log_new RENAME TO model_change_log;
+ALTER TABLE model_change_log RENAME CONSTRAINT model_change_log_new_pkey TO model_change_log_pkey;
+CREATE INDEX model_change_log_data_gin ON model_change_log USING gin (data);
+CREATE INDEX model_change_log_row_idx ON model_change_log (table_name, table_row, "timestamp");
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0006_modelchangelog_row_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(partition_sql, unpartition_sql),
+    ]
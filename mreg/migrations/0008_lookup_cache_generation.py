@@ -0,0 +1,60 @@
+from django.db import migrations
+
+# The lookup caches in mreg.utils.ProcessCache are kept per process, and
+# rebuilt when the generation of their name in lookup_cache_generation
+# changes. The triggers bump the generation in the transaction changing the
+# source tables, so every process sees the change as soon as it commits.
+# Generations are taken from a sequence, so a rolled back generation is
+# never seen again. Zones are saved for every change to their records, so
+# updates only count when the names change.
+
+forward_sql = """
+CREATE SEQUENCE lookup_cache_generation_seq;
+CREATE TABLE lookup_cache_generation (
+    name text PRIMARY KEY,
+    generation bigint NOT NULL
+);
+CREATE FUNCTION bump_lookup_cache_generation() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO lookup_cache_generation (name, generation)
+        VALUES (TG_ARGV[0], nextval('lookup_cache_generation_seq'))
+        ON CONFLICT (name) DO UPDATE SET generation = EXCLUDED.generation;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER forward_zone_lookup_cache
+    AFTER INSERT OR DELETE OR TRUNCATE ON forward_zone
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_lookup_cache_generation('forward_zone_trie');
+CREATE TRIGGER forward_zone_lookup_cache_rename
+    AFTER UPDATE ON forward_zone
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+    EXECUTE PROCEDURE bump_lookup_cache_generation('forward_zone_trie');
+CREATE TRIGGER forward_zone_delegation_lookup_cache
+    AFTER INSERT OR DELETE OR TRUNCATE ON forward_zone_delegation
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_lookup_cache_generation('forward_zone_trie');
+CREATE TRIGGER forward_zone_delegation_lookup_cache_rename
+    AFTER UPDATE ON forward_zone_delegation
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.zone IS DISTINCT FROM NEW.zone)
+    EXECUTE PROCEDURE bump_lookup_cache_generation('forward_zone_trie');
+"""
+
+reverse_sql = """
+DROP TRIGGER forward_zone_delegation_lookup_cache_rename ON forward_zone_delegation;
+DROP TRIGGER forward_zone_delegation_lookup_cache ON forward_zone_delegation;
+DROP TRIGGER forward_zone_lookup_cache_rename ON forward_zone;
+DROP TRIGGER forward_zone_lookup_cache ON forward_zone;
+DROP FUNCTION bump_lookup_cache_generation();
+DROP TABLE lookup_cache_generation;
+DROP SEQUENCE lookup_cache_generation_seq;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0007_modelchangelog_partitioning'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward_sql, reverse_sql),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations
+
+# Bump the generations of the reverse zone and network indexes, see 0008.
+# The network index keeps the whole networks, so any change counts.
+
+forward_sql = """
+CREATE TRIGGER reverse_zone_lookup_cache
+    AFTER INSERT OR DELETE OR TRUNCATE ON reverse_zone
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_lookup_cache_generation('reverse_zone_index');
+CREATE TRIGGER reverse_zone_lookup_cache_rename
+    AFTER UPDATE ON reverse_zone
+    FOR EACH ROW WHEN (OLD.network IS DISTINCT FROM NEW.network)
+    EXECUTE PROCEDURE bump_lookup_cache_generation('reverse_zone_index');
+CREATE TRIGGER network_lookup_cache
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON network
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_lookup_cache_generation('network_index');
+"""
+
+reverse_sql = """
+DROP TRIGGER network_lookup_cache ON network;
+DROP TRIGGER reverse_zone_lookup_cache_rename ON reverse_zone;
+DROP TRIGGER reverse_zone_lookup_cache ON reverse_zone;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0008_lookup_cache_generation'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward_sql, reverse_sql),
+    ]
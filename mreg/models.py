@@ -1,18 +1,28 @@
 import ipaddress
+import re
 from collections import defaultdict
-from datetime import timedelta
+from datetime import datetime, timedelta
 from functools import reduce
+from itertools import groupby, takewhile
+from operator import itemgetter
 
 import django.contrib.postgres.fields as pgfields
 from django.contrib.auth.models import Group
-from django.db import DatabaseError, models, transaction
-from django.db.models import Q
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connection, models, transaction
+from django.db.models import Count, Q
 from django.utils import timezone
 from netfields import CidrAddressField, NetManager
 
 from .fields import DnsNameField, LCICharField
 from .models_auth import User  # noqa: F401, needed by mreg.settings for now
 from .utils import (
+    LabelTrie,
+    NameEncoder,
+    PrefixIndex,
+    ProcessCache,
     clear_none,
     create_serialno,
     encode_mail,
@@ -46,15 +56,18 @@ class NameServer(models.Model):
     def __str__(self):
         return str(self.name)
 
-    def zf_string(self, zone, subzone=None):
-        """String representation for zonefile export."""
+    def zf_string(self, zone, subzone=None, encoder=None):
+        """String representation for zonefile export. Pass a NameEncoder
+        for zone to reuse it between calls."""
+        if encoder is None:
+            encoder = NameEncoder(zone)
         if subzone:
-            subzone = idna_encode(qualify(subzone, zone))
+            subzone = encoder.encode(subzone)
         data = {
             'subzone': clear_none(subzone),
             'ttl': clear_none(self.ttl),
             'record_type': 'NS',
-            'record_data': idna_encode(qualify(self.name, zone))
+            'record_data': encoder.encode(self.name)
         }
         return '{subzone:24} {ttl:5} IN {record_type:6} {record_data}\n'.format_map(data)
 
@@ -148,15 +161,19 @@ $TTL {default_ttl}
 """.format_map(data)
         return zf
 
+    def serialno_update_due(self, force=False):
+        """True if update_serialno() would update the serial number."""
+        # Need the have a timedelta as serialno_updated_at to not exhaust
+        # the 100 possible daily serial numbers.
+        min_delta = timedelta(minutes=1)
+        return force or self.updated and \
+            timezone.now() > self.serialno_updated_at + min_delta
+
     def update_serialno(self, force=False):
         """Update serialno if zone has been updated since the serial number
         was updated.
         """
-        # Need the have a timedelta as serialno_updated_at to not exhaust
-        # the 100 possible daily serial numbers.
-        min_delta = timedelta(minutes=1)
-        if force or self.updated and \
-           timezone.now() > self.serialno_updated_at + min_delta:
+        if self.serialno_update_due(force=force):
             self.serialno = create_serialno(self.serialno)
             self.serialno_updated_at = timezone.now()
             self.updated = False
@@ -173,29 +190,29 @@ class ForwardZone(BaseZone):
     class Meta:
         db_table = 'forward_zone'
 
+    @staticmethod
+    def get_zone_and_delegation_ids(name):
+        """Get the ids of the zone, and of the zone's delegation if any, which
+        a hostname belongs to. Return None if not found."""
+        zones, delegations = forward_zone_trie.get()
+        found = zones.find(name)
+        if found is None:
+            return None
+        zone_id, zone_name = found
+        delegation_id = None
+        if name != zone_name and zone_id in delegations:
+            delegation_id = delegations[zone_id].find(name)
+        return zone_id, delegation_id
+
     @staticmethod
     def get_zone_by_hostname(name):
         """Get zone by hostname.
-        Return zone or None if not found."""
-
-        def _get_reverse_order(lst):
-            """Return index of sorted zones"""
-            # We must sort the zones to assert that foo.example.org hosts
-            # does not end up in the example.org zone.  This is achieved by
-            # spelling the zone postfix backwards and sorting the resulting
-            # list backwards
-            lst = [str(x.name)[::-1] for x in lst]
-            t = range(len(lst))
-            return sorted(t, key=lambda i: lst[i], reverse=True)
-
-        zones = ForwardZone.objects.all()
-        for n in _get_reverse_order(zones):
-            z = zones[n]
-            if z.name == name:
-                return z
-            elif name.endswith(f".{z.name}"):
-                return z
-        return None
+        Return zone or None if not found. Only the id and name are loaded
+        from the trie, the other fields are read from the database if used."""
+        found = forward_zone_trie.get()[0].find(name)
+        if found is None:
+            return None
+        return ForwardZone.from_db(ForwardZone.objects.db, FORWARD_ZONE_TRIE_FIELDS, found)
 
 
 class ReverseZone(BaseZone):
@@ -215,54 +232,67 @@ class ReverseZone(BaseZone):
 
     @staticmethod
     def get_zone_by_ip(ip):
-        """Search and return a zone which contains an IP address."""
-        return ReverseZone.objects.filter(network__net_contains=ip).first()
+        """Search and return a zone which contains an IP address.
+        Only the id, name and network are loaded from the index, the other
+        fields are read from the database if used."""
+        found = reverse_zone_index.get().find(ip)
+        if found is None:
+            return None
+        return ReverseZone.from_db(ReverseZone.objects.db, REVERSE_ZONE_INDEX_FIELDS, found)
+
+    def iter_ipaddresses(self, network=None):
+        """
+        Yields (ip, ttl, hostname) for the PTRs in the zone, sorted by ip,
+        or only those within network if given.
+        Merges the Ipaddresses and PtrOverrides as they are read from two
+        server side cursors, so memory use does not grow with the zone.
+        """
+        if network is None:
+            network = self.network
 
-    def get_ipaddresses(self):
-        network = self.network
-        from_ip = str(network.network_address)
-        to_ip = str(network.broadcast_address)
-        ips = Ipaddress.objects.filter(ipaddress__range=(from_ip, to_ip))
-        ips = ips.select_related('host')
-        override_ips = dict()
-        ptrs = PtrOverride.objects.filter(ipaddress__range=(from_ip, to_ip))
-        ptrs = ptrs.select_related('host')
-        for p in ptrs:
-            override_ips[p.ipaddress] = p
-        # XXX: send signal/mail to hostmaster(?) about issues with multiple_ip_no_ptr
-        count = defaultdict(int)
-        for i in ips:
-            if i.ipaddress not in override_ips:
-                count[i.ipaddress] += 1
-        multiple_ip_no_ptr = {i: count[i] for i in count if count[i] > 1}
-        ptr_done = set()
-        # Use PtrOverrides when found, but only once. Also skip IPaddresses
-        # which have been used multiple times, but lacks a PtrOverride.
-        result = []
-
-        def _add_to_result(item):
-            ttl = item.host.ttl or ""
-            result.append((ipaddress.ip_address(item.ipaddress), ttl, item.host.name))
-
-        for i in ips:
-            ip = i.ipaddress
-            if ip in multiple_ip_no_ptr:
+        def _rows(model):
+            qs = model.objects.filter(ipaddress__net_contained_or_equal=network)
+            qs = qs.order_by('ipaddress').values_list('ipaddress', 'host__ttl', 'host__name')
+            for ip, ttl, hostname in qs.iterator():
+                yield ipaddress.ip_address(ip), ttl or "", hostname
+
+        # Every PtrOverride is used, also those which actually don't override
+        # anything, but are only used as PTRs without any Ipaddress object
+        # creating forward entries.
+        ptrs = _rows(PtrOverride)
+        ptr = next(ptrs, None)
+        for ip, group in groupby(_rows(Ipaddress), key=itemgetter(0)):
+            while ptr is not None and ptr[0] < ip:
+                yield ptr
+                ptr = next(ptrs, None)
+            # Skip IPaddresses which have a PtrOverride, which is yielded
+            # above with the next ip.
+            if ptr is not None and ptr[0] == ip:
                 continue
-            if ip in override_ips:
-                if ip not in ptr_done:
-                    ptr_done.add(ip)
-                    _add_to_result(override_ips[ip])
-            else:
-                _add_to_result(i)
-        # Add PtrOverrides which actually don't override anything,
-        # but are only used as PTRs without any Ipaddress object creating
-        # forward entries.
-        for k, v in override_ips.items():
-            if k not in ptr_done:
-                _add_to_result(v)
+            # Skip IPaddresses which have been used multiple times, but lacks
+            # a PtrOverride. They are listed by get_multiple_ip_no_ptr().
+            first = next(group)
+            if next(group, None) is None:
+                yield first
+        if ptr is not None:
+            yield ptr
+        yield from ptrs
 
-        # Return sorted by IP
-        return sorted(result, key=lambda i: i[0])
+    def get_ipaddresses(self):
+        return list(self.iter_ipaddresses())
+
+    def get_multiple_ip_no_ptr(self):
+        """
+        Returns the ip addresses in the zone used by multiple hosts, but
+        without a PtrOverride, and the names of the hosts. These addresses
+        get no PTR.
+        """
+        ptrs = PtrOverride.objects.filter(ipaddress__net_contained_or_equal=self.network)
+        qs = Ipaddress.objects.filter(ipaddress__net_contained_or_equal=self.network)
+        qs = qs.exclude(ipaddress__in=ptrs.values('ipaddress'))
+        qs = qs.values('ipaddress').annotate(count=Count('id'),
+                                             hosts=ArrayAgg('host__name', ordering='host__name'))
+        return qs.filter(count__gt=1).order_by('ipaddress')
 
 
 class ForwardZoneDelegation(models.Model, ZoneHelpers):
@@ -278,6 +308,41 @@ class ForwardZoneDelegation(models.Model, ZoneHelpers):
         return f"{self.zone.name} {self.name}"
 
 
+FORWARD_ZONE_TRIE_FIELDS = ('id', 'name')
+
+
+def _build_forward_zone_trie():
+    """
+    Returns a trie of the zones, and a dict with a trie of the delegations
+    of each zone. A delegation never hides a zone with the same or a longer
+    name, as the zone of a hostname is found first.
+    """
+    zones = LabelTrie()
+    for values in ForwardZone.objects.values_list(*FORWARD_ZONE_TRIE_FIELDS):
+        zones.add(values[1], values)
+    delegations = defaultdict(LabelTrie)
+    for delegation_id, zone_id, name in ForwardZoneDelegation.objects.values_list('id', 'zone', 'name'):
+        delegations[zone_id].add(name, delegation_id)
+    return zones, dict(delegations)
+
+
+REVERSE_ZONE_INDEX_FIELDS = ('id', 'name', 'network')
+
+
+def _build_reverse_zone_index():
+    index = PrefixIndex()
+    for values in ReverseZone.objects.values_list(*REVERSE_ZONE_INDEX_FIELDS):
+        index.add(values[2], values)
+    return index
+
+
+# Only rebuilt when zones or delegations are created, renamed or deleted, as
+# the zones are saved on every change to their records. See the triggers in
+# migrations 0008 and 0009.
+forward_zone_trie = ProcessCache('forward_zone_trie', _build_forward_zone_trie)
+reverse_zone_index = ProcessCache('reverse_zone_index', _build_reverse_zone_index)
+
+
 class ReverseZoneDelegation(models.Model, ZoneHelpers):
     zone = models.ForeignKey(ReverseZone, on_delete=models.CASCADE, db_column='zone',
                              related_name='delegations')
@@ -291,6 +356,64 @@ class ReverseZoneDelegation(models.Model, ZoneHelpers):
         return f"{self.zone.name} {self.name}"
 
 
+class ZoneSnapshot(models.Model):
+    """The resource records of a zone at the last journaled serial number."""
+    zone = LCICharField(max_length=253, unique=True)
+    serialno = models.BigIntegerField()
+    records = models.TextField()
+
+    class Meta:
+        db_table = 'zone_snapshot'
+
+    def __str__(self):
+        return f"{self.zone} {self.serialno}"
+
+
+class ZoneJournal(models.Model):
+    """Resource records removed from and added to a zone between two serial
+    numbers. Records are stored one per line."""
+    zone = LCICharField(max_length=253)
+    from_serial = models.BigIntegerField()
+    to_serial = models.BigIntegerField()
+    removed = models.TextField(blank=True)
+    added = models.TextField(blank=True)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'zone_journal'
+        unique_together = ('zone', 'from_serial')
+
+    def __str__(self):
+        return f"{self.zone} {self.from_serial} -> {self.to_serial}"
+
+    @classmethod
+    def get_changes(cls, zone, from_serial, to_serial):
+        """Returns the records removed and added in zone between from_serial
+        and to_serial, or None if the journal does not cover the range."""
+        entries = cls.objects.filter(zone=zone, from_serial__gte=from_serial,
+                                     to_serial__lte=to_serial)
+        entries = {i.from_serial: i for i in entries}
+        removed = set()
+        added = set()
+        serial = from_serial
+        while serial != to_serial:
+            entry = entries.get(serial)
+            if entry is None:
+                return None
+            for record in entry.removed.splitlines():
+                if record in added:
+                    added.remove(record)
+                else:
+                    removed.add(record)
+            for record in entry.added.splitlines():
+                if record in removed:
+                    removed.remove(record)
+                else:
+                    added.add(record)
+            serial = entry.to_serial
+        return removed, added
+
+
 class ForwardZoneMember(models.Model):
     zone = models.ForeignKey(ForwardZone, models.DO_NOTHING, db_column='zone',
                              blank=True, null=True)
@@ -345,13 +468,15 @@ class Sshfp(models.Model):
 class Ipaddress(models.Model):
     host = models.ForeignKey(Host, on_delete=models.CASCADE, db_column='host',
                              related_name='ipaddresses')
-    ipaddress = models.GenericIPAddressField()
+    ipaddress = models.GenericIPAddressField(db_index=True)
     macaddress = models.CharField(max_length=17, blank=True, validators=[validate_mac_address])
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         db_table = 'ipaddress'
         unique_together = (('host', 'ipaddress'), )
+        indexes = [GistIndex(fields=['ipaddress'], opclasses=['inet_ops'],
+                             name='ipaddress_ipaddress_gist')]
 
     def __str__(self):
         return "{} -> {}".format(str(self.ipaddress), str(self.macaddress) or "None")
@@ -394,6 +519,8 @@ class PtrOverride(models.Model):
 
     class Meta:
         db_table = 'ptr_override'
+        indexes = [GistIndex(fields=['ipaddress'], opclasses=['inet_ops'],
+                             name='ptr_override_ipaddress_gist')]
 
     def __str__(self):
         return "{} -> {}".format(str(self.ipaddress), str(self.host.name))
@@ -426,6 +553,10 @@ class Cname(ForwardZoneMember):
         return "{} -> {}".format(str(self.name), str(self.host))
 
 
+# Namespace for advisory locks on networks, "mreg" in ASCII.
+NETWORK_LOCK_NAMESPACE = 0x6d726567
+
+
 class Network(models.Model):
     network = CidrAddressField(unique=True)
     description = models.TextField(blank=True)
@@ -456,6 +587,21 @@ class Network(models.Model):
             self.reserved = network.num_addresses
         super().save(*args, **kwargs)
 
+    def lock(self):
+        """
+        Takes an advisory lock on the network, held until the end of the
+        current transaction. Serializes allocations of ip addresses.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)',
+                           [NETWORK_LOCK_NAMESPACE, self.id])
+
+    @staticmethod
+    def get_network_by_ip(ip, strict=True):
+        """Return the network containing ip, or None. The network is shared
+        by all callers in the process and must not be changed."""
+        return network_index.get().find(ip, strict=strict)
+
     def get_reserved_ipaddresses(self):
         """ Returns a set with the reserved ip addresses for the network."""
         network = self.network
@@ -467,13 +613,13 @@ class Network(models.Model):
         return ret
 
     def _get_used_ipaddresses(self):
-        from_ip = str(self.network.network_address)
-        to_ip = str(self.network.broadcast_address)
-        return Ipaddress.objects.filter(ipaddress__range=(from_ip, to_ip))
+        return Ipaddress.objects.filter(ipaddress__net_contained_or_equal=self.network)
 
     def get_used_ipaddresses(self):
         """
-        Returns the used ipaddress on the network.
+        Returns the used ipaddress on the network, those of Ipaddresses.
+        The unused addresses leave out PtrOverrides too, see
+        _used_ipaddresses_sql().
         """
         ips = self._get_used_ipaddresses()
         used = {ipaddress.ip_address(i.ipaddress) for i in ips}
@@ -485,47 +631,222 @@ class Network(models.Model):
         """
         return self._get_used_ipaddresses().count()
 
+    def _get_host_range(self):
+        """
+        Returns the first and last address of network.hosts() as integers.
+        """
+        network = self.network
+        first = int(network.network_address)
+        last = int(network.broadcast_address)
+        if network.prefixlen < network.max_prefixlen - 1:
+            first += 1
+            if isinstance(network, ipaddress.IPv4Network):
+                last -= 1
+        return first, last
+
+    def _get_unreserved_range(self):
+        """
+        Returns the first and last address of the network which is not
+        reserved as integers. The reserved addresses are the network address,
+        the first hosts and for IPv4 the broadcast address, so every address
+        outside the range is reserved.
+        """
+        network = self.network
+        first = max(self._get_host_range()[0] + self.reserved,
+                    int(network.network_address) + 1)
+        last = int(network.broadcast_address)
+        if isinstance(network, ipaddress.IPv4Network):
+            last -= 1
+        return first, last
+
+    @staticmethod
+    def _used_ipaddresses_sql(first, last):
+        """
+        Returns SQL selecting the used addresses between the inet expressions
+        first and last, with duplicates. An address is used if an Ipaddress
+        or a PtrOverride has it, as the PtrOverride gives its PTR record.
+        Every count and list of unused addresses must use this.
+        """
+        return f"""
+            SELECT ipaddress FROM {Ipaddress._meta.db_table}
+            WHERE ipaddress BETWEEN {first} AND {last}
+            UNION ALL
+            SELECT ipaddress FROM {PtrOverride._meta.db_table}
+            WHERE ipaddress BETWEEN {first} AND {last}
+        """
+
+    def _get_unreserved_params(self):
+        """
+        Returns the first and last unreserved address as strings, for the
+        parameters to _used_ipaddresses_sql(), or None if all are reserved.
+        """
+        first, last = self._get_unreserved_range()
+        if first > last:
+            return None
+        ip_address = type(self.network.network_address)
+        return {'first': str(ip_address(first)), 'last': str(ip_address(last))}
+
+    def _get_unused_ranges(self):
+        first, last = self._get_unreserved_range()
+        ranges = []
+        params = self._get_unreserved_params()
+        if params is None:
+            return ranges
+        query = f"""
+            SELECT DISTINCT ipaddress
+            FROM ({self._used_ipaddresses_sql('%(first)s::inet', '%(last)s::inet')}) AS used
+            ORDER BY ipaddress
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            used = [int(ipaddress.ip_interface(str(row[0])).ip) for row in cursor.fetchall()]
+        for ip in used:
+            if ip > first:
+                ranges.append((first, ip - 1))
+            first = ip + 1
+        if first <= last:
+            ranges.append((first, last))
+        return ranges
+
+    def get_unused_ranges(self):
+        """
+        Returns the unused ip-addresses on the network as a sorted list of
+        (first, last) tuples. Uses memory by the number of used addresses,
+        not by the size of the network.
+        """
+        ip_address = type(self.network.network_address)
+        return [(ip_address(first), ip_address(last))
+                for first, last in self._get_unused_ranges()]
+
+    def iter_unused_ipaddresses(self, after=None):
+        """
+        Yields the unused ip-addresses on the network in order, starting
+        after the address after, if given.
+        """
+        ip_address = type(self.network.network_address)
+        start = int(ipaddress.ip_address(after)) + 1 if after is not None else 0
+        for first, last in self._get_unused_ranges():
+            if last < start:
+                continue
+            for ip in range(max(first, start), last + 1):
+                yield ip_address(ip)
+
     def get_unused_ipaddresses(self):
         """
         Returns which ip-addresses on the network are unused.
         """
-        network_ips = []
+        unused = self.iter_unused_ipaddresses()
         if isinstance(self.network, ipaddress.IPv6Network):
             # Getting all availible IPs for a ipv6 prefix can easily cause
             # the webserver to hang due to lots and lots of IPs. Instead limit
-            # to the first 4000 hosts. Should probably be configurable.
-            for ip in self.network.hosts():
-                if len(network_ips) == 4000:
-                    break
-                network_ips.append(ip)
-        else:
-            network_ips = self.network.hosts()
+            # to the first 4000 hosts. Use iter_unused_ipaddresses() to page
+            # through all of them.
+            end = self._get_host_range()[0] + 4000
+            unused = takewhile(lambda ip: int(ip) < end, unused)
+        return set(unused)
 
-        reserved = self.get_reserved_ipaddresses()
-        used = self.get_used_ipaddresses()
-        return set(network_ips) - reserved - used
+    @staticmethod
+    def get_usage(networks):
+        """
+        Returns a list with the size, and the number of reserved, used and
+        unused addresses, of the networks, which add up to the size. Counted
+        in a single query. Used counts the addresses outside the reserved
+        ones which are used, see _used_ipaddresses_sql(), so unused is the
+        same as unused_count.
+        """
+        networks = list(networks)
+        if not networks:
+            return []
+        values = []
+        params = []
+        unreserved = {}
+        for network in networks:
+            net = network.network
+            first, last = network._get_unreserved_range()
+            unreserved[network.id] = max(0, last - first + 1)
+            if first <= last:
+                ip_address = type(net.network_address)
+                first, last = str(ip_address(first)), str(ip_address(last))
+            else:
+                first = last = None
+            values.append('(%s, %s::inet, %s::inet)')
+            params += [network.id, first, last]
+        query = f"""
+            SELECT net.id,
+                   (SELECT COUNT(DISTINCT ipaddress)
+                    FROM ({Network._used_ipaddresses_sql('net.first', 'net.last')}) AS used)
+            FROM (VALUES {", ".join(values)}) AS net (id, first, last)
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            counts = dict(cursor.fetchall())
+        ret = []
+        for network in networks:
+            size = network.network.num_addresses
+            used = counts[network.id]
+            ret.append({'network': str(network.network),
+                        'size': size,
+                        'reserved': size - unreserved[network.id],
+                        'used': used,
+                        'unused': unreserved[network.id] - used})
+        return ret
 
     def get_unused_ipaddress_count(self):
         """
         Returns the number of unused ipaddreses on the network.
         """
-        reserved = self.get_reserved_ipaddresses()
-        used = self.get_used_ipaddresses()
-        return self.network.num_addresses - len(reserved | used)
+        params = self._get_unreserved_params()
+        if params is None:
+            return 0
+        first, last = self._get_unreserved_range()
+        query = f"""
+            SELECT COUNT(DISTINCT ipaddress)
+            FROM ({self._used_ipaddresses_sql('%(first)s::inet', '%(last)s::inet')}) AS used
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            used = cursor.fetchone()[0]
+        return last - first + 1 - used
 
     def get_first_unused(self):
         """
-        Return the first unused IP found, if any.
+        Return the first unused IP found, if any. An IP is unused if it is
+        neither reserved nor used, see _used_ipaddresses_sql().
+        """
+        params = self._get_unreserved_params()
+        if params is None:
+            return None
+        # Walk the used addresses in index order, with first - 1 as a
+        # sentinel, and stop at the first address not followed by the next
+        # address. Only the used addresses before the first gap are read.
+        query = f"""
+            SELECT ip + 1 FROM (
+                SELECT ip, lead(ip) OVER (ORDER BY ip) AS next_ip FROM (
+                    SELECT %(first)s::inet - 1 AS ip
+                    UNION ALL
+                    {self._used_ipaddresses_sql('%(first)s::inet', '%(last)s::inet')}
+                ) AS used
+            ) AS gaps
+            WHERE ip < %(last)s::inet AND (next_ip IS NULL OR next_ip > ip + 1)
+            ORDER BY ip
+            LIMIT 1
         """
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return str(ipaddress.ip_interface(str(row[0])).ip)
+
+
+def _build_network_index():
+    index = PrefixIndex()
+    for network in Network.objects.all():
+        index.add(network.network, network)
+    return index
 
-        reserved = self.get_reserved_ipaddresses()
-        used = self.get_used_ipaddresses()
-        for ip in self.network.hosts():
-            if ip in reserved:
-                continue
-            if ip not in used:
-                return str(ip)
-        return None
+
+network_index = ProcessCache('network_index', _build_network_index)
 
 
 class Naptr(models.Model):
@@ -626,14 +947,157 @@ class NetGroupRegexPermission(models.Model):
         return qs
 
 
+def _month_start(year, month):
+    """Return the start of a month in UTC. The month may be outside 1-12,
+    and then counts from the start of year."""
+    year, month = divmod(year * 12 + month - 1, 12)
+    return datetime(year, month + 1, 1, tzinfo=timezone.utc)
+
+
 # TODO: Add user_id functionality when auth is implemented
 class ModelChangeLog(models.Model):
+    """The table is partitioned by month on timestamp, see migration 0007.
+    Entries without a monthly partition end up in model_change_log_default.
+    """
     # user_id = models.BigIntegerField(db_index=True)
     table_name = models.CharField(max_length=132)
     table_row = models.BigIntegerField()
-    data = models.TextField()
+    data = pgfields.JSONField(encoder=DjangoJSONEncoder)
     action = models.CharField(max_length=16)  # saved or deleted
     timestamp = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         db_table = "model_change_log"
+        indexes = [GinIndex(fields=['data'], name='model_change_log_data_gin'),
+                   models.Index(fields=['table_name', 'table_row', 'timestamp'],
+                                name='model_change_log_row_idx')]
+
+    @staticmethod
+    def get_table_names():
+        """Return the names of the tables with entries. Instead of reading
+        every entry, the index is searched once for each table name, by
+        looking up the next name after the previous one."""
+        query = """
+            WITH RECURSIVE t(table_name) AS (
+                (SELECT table_name FROM model_change_log ORDER BY table_name LIMIT 1)
+                UNION ALL
+                SELECT (SELECT table_name FROM model_change_log
+                        WHERE table_name > t.table_name ORDER BY table_name LIMIT 1)
+                FROM t WHERE t.table_name IS NOT NULL
+            )
+            SELECT table_name FROM t WHERE table_name IS NOT NULL
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+            return [row[0] for row in cursor.fetchall()]
+
+    @staticmethod
+    def diff(old, new):
+        """Return the keys changed between two entries' data, as
+        {key: [old value, new value]}."""
+        return {key: [old.get(key), new.get(key)] for key in old.keys() | new.keys()
+                if old.get(key) != new.get(key)}
+
+    @classmethod
+    def search(cls, table_name, contains, at=None):
+        """Return the entries for table_name whose data contains the JSON
+        object contains. If at is given, only the entries which were the
+        latest for their row at that time."""
+        qs = cls.objects.filter(table_name=table_name)
+        if at is None:
+            return qs.filter(data__contains=contains).order_by('table_row', 'timestamp')
+        qs = qs.filter(timestamp__lte=at)
+        # The GIN index finds the candidate rows, and only their history
+        # is searched for the latest entry.
+        candidates = qs.filter(data__contains=contains).values('table_row')
+        latest = qs.filter(table_row__in=candidates).order_by('table_row', '-timestamp') \
+                   .distinct('table_row').values('id')
+        return cls.objects.filter(id__in=latest, data__contains=contains).order_by('table_row')
+
+    @staticmethod
+    def partition_name(month):
+        return f'model_change_log_{month:%Y_%m}'
+
+    @classmethod
+    def get_partition_entries(cls, month):
+        return cls.objects.filter(timestamp__gte=month,
+                                  timestamp__lt=_month_start(month.year, month.month + 1))
+
+    @staticmethod
+    def get_partitions():
+        """Return the start of every month with a partition, sorted."""
+        query = """
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = 'model_change_log'::regclass
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+            names = [row[0] for row in cursor.fetchall()]
+        months = []
+        for name in names:
+            match = re.fullmatch(r'model_change_log_(\d{4})_(\d{2})', name)
+            if match:
+                months.append(_month_start(int(match[1]), int(match[2])))
+        return sorted(months)
+
+    @classmethod
+    def create_partition(cls, month):
+        """Create the partition for the month starting at month. Its entries
+        are moved to it from the default partition, as a partition can not
+        be added while the default partition has entries belonging to it."""
+        name = cls.partition_name(month)
+        end = _month_start(month.year, month.month + 1)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'CREATE TABLE "{name}" (LIKE model_change_log INCLUDING DEFAULTS)')
+            cursor.execute(f"""
+                WITH moved AS (
+                    DELETE FROM model_change_log_default
+                    WHERE "timestamp" >= %s AND "timestamp" < %s
+                    RETURNING *
+                )
+                INSERT INTO "{name}" SELECT * FROM moved
+            """, [month, end])
+            cursor.execute(f'ALTER TABLE model_change_log ATTACH PARTITION "{name}" '
+                           'FOR VALUES FROM (%s) TO (%s)', [month, end])
+
+    @classmethod
+    def drop_partition(cls, month):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE "{cls.partition_name(month)}"')
+
+    @classmethod
+    def split_default_partition(cls):
+        """Create the partitions for the entries in the default partition.
+        Returns the months created."""
+        query = """
+            SELECT DISTINCT date_trunc('month', "timestamp") FROM model_change_log_default
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+            months = sorted(row[0] for row in cursor.fetchall())
+        for month in months:
+            cls.create_partition(month)
+        return months
+
+    @classmethod
+    def ensure_partitions(cls, months_ahead):
+        """Create the partitions for this month and months_ahead months.
+        Returns the months created."""
+        now = timezone.now()
+        existing = set(cls.get_partitions())
+        created = []
+        for i in range(months_ahead + 1):
+            month = _month_start(now.year, now.month + i)
+            if month not in existing:
+                cls.create_partition(month)
+                created.append(month)
+        return created
+
+    @classmethod
+    def get_expired_partitions(cls, keep_months):
+        """Return the months with a partition before the last keep_months
+        months, this month excluded."""
+        now = timezone.now()
+        cutoff = _month_start(now.year, now.month - keep_months)
+        return [month for month in cls.get_partitions() if month < cutoff]
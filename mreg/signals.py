@@ -1,21 +1,29 @@
-import functools
 import re
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
 
 from django.conf import settings
 from django.contrib.auth.models import Group
+from django.db import transaction
 from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
+from django.utils import timezone
 
 from django_auth_ldap.backend import populate_user
 
 from rest_framework.exceptions import PermissionDenied
 
 from mreg.api.v1.serializers import HostSerializer
+from mreg.api.v1.zonefile import invalidate_zonefile_cache
 
-from .models import (Cname, ForwardZoneMember, Hinfo, Host, HostGroup, Ipaddress, Loc,
-                     ModelChangeLog, Mx, NameServer, Naptr,
-                     NetGroupRegexPermission, Network, PtrOverride,
-                     ReverseZone, Srv, Sshfp, Txt)
+from .models import (Cname, ForwardZone, ForwardZoneDelegation, ForwardZoneMember,
+                     Hinfo, Host, HostGroup, Ipaddress, Loc, ModelChangeLog, Mx,
+                     NameServer, Naptr, NetGroupRegexPermission, Network, PtrOverride,
+                     ReverseZone, Srv, Sshfp, Txt, ZoneJournal, ZoneSnapshot,
+                     forward_zone_trie, network_index, reverse_zone_index)
+from .utils import cached_generations
 
 
 @receiver(populate_user)
@@ -57,11 +65,6 @@ def updated_ipaddress_fix_ptroverride(sender, instance, raw, using, update_field
 
 
 def _common_update_zone(signal, sender, instance):
-
-    @functools.lru_cache()
-    def _get_zone_for_ip(ip):
-        return ReverseZone.get_zone_by_ip(ip)
-
     zones = set()
 
     if isinstance(instance, ForwardZoneMember):
@@ -77,7 +80,7 @@ def _common_update_zone(signal, sender, instance):
             zones.add(oldzone)
 
     if sender in (Ipaddress, PtrOverride):
-        zone = _get_zone_for_ip(instance.ipaddress)
+        zone = ReverseZone.get_zone_by_ip(instance.ipaddress)
         zones.add(zone)
 
     # Check if host has been renamed, and if so, update other zones
@@ -90,12 +93,105 @@ def _common_update_zone(signal, sender, instance):
                     zones.add(i.zone)
             for model in (Ipaddress, PtrOverride):
                 for i in model.objects.filter(host=instance):
-                    zones.add(_get_zone_for_ip(i.ipaddress))
+                    zones.add(ReverseZone.get_zone_by_ip(i.ipaddress))
+
+    zones.discard(None)
+    if zones:
+        ZoneUpdates.add(zones)
+
+
+_batches = threading.local()
+
+
+@contextmanager
+def batch_changes():
+    """Collect the changes added to a CommitBatch in the block, and write
+    them at its end, in the same transaction as the block. The lookup
+    caches read their generations once in the block. A nested block is
+    part of the outermost one."""
+    if getattr(_batches, 'active', None) is not None:
+        yield
+        return
+    batches = _batches.active = dict()
+    try:
+        with transaction.atomic(), cached_generations():
+            yield
+            _batches.active = None
+            for batch in batches.values():
+                batch.flush()
+    finally:
+        _batches.active = None
+
+
+class CommitBatch(ABC):
+    """Changes collected in a batch_changes() block, to be written all at
+    once at its end. Outside of a block they are written right away."""
+
+    @classmethod
+    def add(cls, *args):
+        batches = getattr(_batches, 'active', None)
+        if batches is None:
+            batch = cls()
+            batch.collect(*args)
+            batch.flush()
+            return
+        if cls not in batches:
+            batches[cls] = cls()
+        batches[cls].collect(*args)
+
+    @abstractmethod
+    def collect(self, *args):
+        """Add changes to the batch."""
+
+    @abstractmethod
+    def flush(self):
+        """Write the changes in the batch."""
+
+
+class ZoneUpdates(CommitBatch):
+    """Zones marked as updated. They are updated, and their cached zonefiles
+    invalidated, with a query or two per zone model, instead of saving a
+    zone for every changed record."""
 
-    for zone in zones:
-        if zone:
-            zone.updated = True
-            zone.save()
+    def __init__(self):
+        self.ids = defaultdict(set)
+
+    def collect(self, zones):
+        for zone in zones:
+            self.ids[type(zone)].add(zone.id)
+
+    def flush(self):
+        now = timezone.now()
+        for model, ids in self.ids.items():
+            model.objects.filter(id__in=ids).update(updated=True, updated_at=now)
+            for zone in model.objects.filter(id__in=ids).only('id', 'name', 'serialno'):
+                invalidate_zonefile_cache(zone)
+        self.ids.clear()
+
+
+class HostHistory(CommitBatch):
+    """Hosts with changed records. A single snapshot of each host is added
+    to the history, instead of one for every changed record."""
+
+    def __init__(self):
+        self.actions = dict()
+        self.entries = []
+
+    def collect(self, host_id, action, entry=None):
+        if entry is None:
+            self.actions[host_id] = action
+        else:
+            self.actions.pop(host_id, None)
+            self.entries.append(entry)
+
+    def flush(self):
+        entries = self.entries
+        # Hosts deleted since were logged by host_history_on_delete().
+        for host in Host.objects.filter(id__in=self.actions):
+            entries.append(_host_history_entry(host, self.actions[host.id]))
+        ModelChangeLog.objects.bulk_create(entries)
+        self.actions = dict()
+        self.entries = []
 
 
 @receiver(pre_save, sender=Cname)
@@ -128,6 +224,38 @@ def updated_objects_update_zone_serial(sender, instance, raw, using, update_fiel
 def deleted_objects_update_zone_serial(sender, instance, using, **kwargs):
     _common_update_zone("post_delete", sender, instance)
 
+
+@receiver(post_delete, sender=ForwardZone)
+@receiver(post_delete, sender=ReverseZone)
+def deleted_zone_remove_journal(sender, instance, using, **kwargs):
+    """A new zone with the same name starts with a new journal."""
+    ZoneJournal.objects.filter(zone=instance.name).delete()
+    ZoneSnapshot.objects.filter(zone=instance.name).delete()
+
+
+# The triggers bump the generations of the lookup caches for every change,
+# but a cached_generations() block only reads them once, so it must read
+# them again after changing the tables itself.
+@receiver(post_save, sender=ForwardZone)
+@receiver(post_delete, sender=ForwardZone)
+@receiver(post_save, sender=ForwardZoneDelegation)
+@receiver(post_delete, sender=ForwardZoneDelegation)
+def forward_zone_forget_generation(sender, instance, **kwargs):
+    forward_zone_trie.forget()
+
+
+@receiver(post_save, sender=ReverseZone)
+@receiver(post_delete, sender=ReverseZone)
+def reverse_zone_forget_generation(sender, instance, **kwargs):
+    reverse_zone_index.forget()
+
+
+@receiver(post_save, sender=Network)
+@receiver(post_delete, sender=Network)
+def network_forget_generation(sender, instance, **kwargs):
+    network_index.forget()
+
+
 # To log host history, an approach using post_save signals for related objects was chosen.
 # Ex: When you update an Ipaddress, the Hosts model object itself is not saved, so reading the
 # post_save signal from the Hosts model you won't get anything useful.
@@ -135,9 +263,25 @@ def deleted_objects_update_zone_serial(sender, instance, using, **kwargs):
 # Additionally, the Hosts object is saved before the related objects when creating a new host,
 # so ipaddress data isn't available at the time of post_save for the Hosts object.
 #
-# Currently saves a JSON-snapshot of all data for the host.
-# TODO: Deleting a host should probably do something. Export/delete log for
-# that host after some time?
+# Currently saves a JSON-snapshot of all data for the host, once per
+# batch_changes() block, which is once per request. A deleted host is logged
+# before it is gone, see host_history_on_delete().
+# Old entries are archived and removed with the history_partitions
+# management command.
+
+
+def _host_history_entry(host, action):
+    hostdata = HostSerializer(host).data
+
+    # Cleaning up data from related tables
+    hostdata['ipaddresses'] = [record['ipaddress'] for record in hostdata['ipaddresses']]
+    hostdata['txts'] = [record['txt'] for record in hostdata['txts']]
+    hostdata['cnames'] = [record['name'] for record in hostdata['cnames']]
+    hostdata['ptr_overrides'] = [record['ipaddress'] for record in hostdata['ptr_overrides']]
+    return ModelChangeLog(table_name='host',
+                          table_row=hostdata['id'],
+                          data=hostdata,
+                          action=action)
 
 
 @receiver(post_save, sender=PtrOverride)
@@ -147,20 +291,8 @@ def deleted_objects_update_zone_serial(sender, instance, using, **kwargs):
 @receiver(post_save, sender=Naptr)
 def save_host_history_on_save(sender, instance, created, **kwargs):
     """Receives post_save signal for models that have a ForeignKey to Hosts and
-       updates the host history log."""
-
-    hostdata = HostSerializer(Host.objects.get(pk=instance.host_id)).data
-
-    # Cleaning up data from related tables
-    hostdata['ipaddresses'] = [record['ipaddress'] for record in hostdata['ipaddresses']]
-    hostdata['txts'] = [record['txt'] for record in hostdata['txts']]
-    hostdata['cnames'] = [record['name'] for record in hostdata['cnames']]
-    hostdata['ptr_overrides'] = [record['ipaddress'] for record in hostdata['ptr_overrides']]
-    new_log_entry = ModelChangeLog(table_name='host',
-                                   table_row=hostdata['id'],
-                                   data=hostdata,
-                                   action='saved')
-    new_log_entry.save()
+       updates the host history log at the end of the batch."""
+    HostHistory.add(instance.host_id, 'saved')
 
 
 @receiver(post_delete, sender=PtrOverride)
@@ -170,21 +302,8 @@ def save_host_history_on_save(sender, instance, created, **kwargs):
 @receiver(post_delete, sender=Naptr)
 def save_host_history_on_delete(sender, instance, **kwargs):
     """Receives post_delete signal for models that have a ForeignKey to Hosts
-       and updates the host history log."""
-
-    hostdata = HostSerializer(Host.objects.get(pk=instance.host_id)).data
-
-    # Cleaning up data from related tables
-    hostdata['ipaddresses'] = [record['ipaddress'] for record in hostdata['ipaddresses']]
-    hostdata['txts'] = [record['txt'] for record in hostdata['txts']]
-    hostdata['cnames'] = [record['name'] for record in hostdata['cnames']]
-    hostdata['ptr_overrides'] = [record['ipaddress'] for record in hostdata['ptr_overrides']]
-
-    new_log_entry = ModelChangeLog(table_name='host',
-                                   table_row=hostdata['id'],
-                                   data=hostdata,
-                                   action='deleted')
-    new_log_entry.save()
+       and updates the host history log at the end of the batch."""
+    HostHistory.add(instance.host_id, 'deleted')
 
 
 def _host_update_m2m_relations(instance):
@@ -288,6 +407,15 @@ def prevent_nameserver_deletion(sender, instance, using, **kwargs):
                                       'be deleted until it is removed from them.')
 
 
+# Must come after prevent_nameserver_deletion(), to not log a host which
+# is not deleted.
+@receiver(pre_delete, sender=Host)
+def host_history_on_delete(sender, instance, using, **kwargs):
+    """Log the last snapshot of a deleted host, as it will be gone by the
+       end of the batch."""
+    HostHistory.add(instance.id, 'deleted', _host_history_entry(instance, 'deleted'))
+
+
 @receiver(post_delete, sender=Network)
 def cleanup_network_permissions(sender, instance, **kwargs):
     """Remove any permissions equal to or smaller than the newly deleted
@@ -1,15 +1,29 @@
+import gzip
+import importlib
+import ipaddress
+import json
+import os
+import tempfile
 from datetime import timedelta
+from io import StringIO
 
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from rest_framework.exceptions import PermissionDenied
 
-from .models import (Cname, ForwardZone, Host, HostGroup, Ipaddress,
-                     Loc, ModelChangeLog, NameServer, Naptr,
+from .models import (Cname, ForwardZone, ForwardZoneDelegation, Hinfo, Host, HostGroup,
+                     Ipaddress, Loc, ModelChangeLog, Mx, NameServer, Naptr,
                      NetGroupRegexPermission, Network, PtrOverride,
-                     ReverseZone, Srv, Sshfp, Txt)
+                     ReverseZone, Srv, Sshfp, Txt, _build_forward_zone_trie,
+                     _build_network_index)
+from .signals import _host_history_entry, batch_changes
+from .utils import NameEncoder, ProcessCache, idna_encode, qualify
 
 
 def clean_and_save(entity):
@@ -405,6 +419,20 @@ class ModelNetworkTestCase(TestCase):
         new_count = Network.objects.count()
         self.assertNotEqual(old_count, new_count)
 
+    def test_get_network_by_ip(self):
+        """The longest network containing an ip is found"""
+        clean_and_save(self.network_sample)
+        clean_and_save(self.network_ipv6_sample)
+        subnet = Network.objects.create(network='10.0.1.0/24')
+        host = Network.objects.create(network='10.0.1.5/32')
+        self.assertEqual(Network.get_network_by_ip('10.0.2.1'), self.network_sample)
+        self.assertEqual(Network.get_network_by_ip('10.0.1.5'), subnet)
+        self.assertEqual(Network.get_network_by_ip('10.0.1.5', strict=False), host)
+        self.assertEqual(Network.get_network_by_ip('2001:db8::1'), self.network_ipv6_sample)
+        self.assertIsNone(Network.get_network_by_ip('10.1.0.1'))
+        subnet.delete()
+        self.assertEqual(Network.get_network_by_ip('10.0.1.6'), self.network_sample)
+
     def test_model_can_delete_ipv6_network(self):
         """Test that the model is able to delete a Network."""
         clean_and_save(self.network_ipv6_sample)
@@ -786,6 +814,40 @@ class ModelForwardZoneTestCase(TestCase):
         new_count = ForwardZone.objects.count()
         self.assertNotEqual(old_count, new_count)
 
+    def test_get_zone_by_hostname(self):
+        """The longest matching zone is found, also after zones change"""
+        clean_and_save(self.zone_sample)
+        sub = ForwardZone.objects.create(name='sub.example.org', primary_ns='ns.example.org',
+                                         email='hostmaster@example.org')
+        self.assertEqual(ForwardZone.get_zone_by_hostname('example.org'), self.zone_sample)
+        self.assertEqual(ForwardZone.get_zone_by_hostname('host.example.org'), self.zone_sample)
+        self.assertEqual(ForwardZone.get_zone_by_hostname('host.sub.example.org'), sub)
+        self.assertEqual(ForwardZone.get_zone_by_hostname('host.xsub.example.org'), self.zone_sample)
+        self.assertIsNone(ForwardZone.get_zone_by_hostname('example.com'))
+        self.assertIsNone(ForwardZone.get_zone_by_hostname('org'))
+        delegation = ForwardZoneDelegation.objects.create(zone=self.zone_sample, name='del.example.org')
+        self.assertEqual(ForwardZone.get_zone_and_delegation_ids('host.del.example.org'),
+                         (self.zone_sample.id, delegation.id))
+        self.assertEqual(ForwardZone.get_zone_by_hostname('host.del.example.org'), self.zone_sample)
+        sub.name = 'sub.example.com'
+        sub.save()
+        self.assertEqual(ForwardZone.get_zone_by_hostname('host.sub.example.org'), self.zone_sample)
+        self.assertEqual(ForwardZone.get_zone_by_hostname('host.sub.example.com'), sub)
+        sub.delete()
+        self.assertIsNone(ForwardZone.get_zone_by_hostname('host.sub.example.com'))
+
+    def test_delegation_does_not_hide_zone(self):
+        """A delegation with the name of a zone, or below it, must not hide
+        the zone"""
+        clean_and_save(self.zone_sample)
+        sub = ForwardZone.objects.create(name='sub.example.org', primary_ns='ns.example.org',
+                                         email='hostmaster@example.org')
+        ForwardZoneDelegation.objects.create(zone=self.zone_sample, name='sub.example.org')
+        ForwardZoneDelegation.objects.create(zone=self.zone_sample, name='del.sub.example.org')
+        for name in ('sub.example.org', 'host.sub.example.org', 'host.del.sub.example.org'):
+            self.assertEqual(ForwardZone.get_zone_by_hostname(name), sub)
+            self.assertEqual(ForwardZone.get_zone_and_delegation_ids(name), (sub.id, None))
+
     def test_update_serialno(self):
         """Force update by setting serialno_updated_at in the past"""
         zone = ForwardZone(name='example.org', primary_ns='ns.example.org',
@@ -1108,3 +1170,211 @@ class NetGroupRegexPermissionTestCase(TestCase):
         self.assertEqual(NetGroupRegexPermission.objects.first(), v6perm)
         self.network_v6.delete()
         self.assertEqual(NetGroupRegexPermission.objects.count(), 0)
+
+
+class NameEncoderTestCase(TestCase):
+    """The NameEncoder must give the same result as qualify() and idna_encode()."""
+
+    def test_same_as_qualify(self):
+        zone = 'example.org'
+        encoder = NameEncoder(zone)
+        for name in ('example.org', 'host.example.org', 'høst.sub.example.org',
+                     'host.example.com', 'host.example.com.', '*.example.org'):
+            for shortform in (True, False):
+                self.assertEqual(encoder.encode(name, shortform=shortform),
+                                 idna_encode(qualify(name, zone, shortform=shortform)))
+
+
+class ProcessCacheTestCase(TestCase):
+    """A lookup cache must see changes made by any process."""
+
+    def test_forward_zone_trie(self):
+        # Another instance, as the one in another process.
+        trie = ProcessCache('forward_zone_trie', _build_forward_zone_trie)
+        self.assertIsNone(trie.get()[0].find('host.example.org'))
+        zone = ForwardZone.objects.create(name='example.org', primary_ns='ns.example.org',
+                                          email='hostmaster@example.org')
+        self.assertEqual(trie.get()[0].find('host.example.org'), (zone.id, 'example.org'))
+        # No signals are sent for an update().
+        ForwardZone.objects.filter(id=zone.id).update(name='example.com')
+        self.assertIsNone(trie.get()[0].find('host.example.org'))
+        self.assertEqual(trie.get()[0].find('host.example.com'), (zone.id, 'example.com'))
+
+    def test_invalidate_from_other_instance(self):
+        builds = []
+
+        def builder():
+            builds.append(None)
+            return len(builds)
+
+        cache = ProcessCache('test', builder)
+        other = ProcessCache('test', builder)
+        self.assertEqual(cache.get(), 1)
+        self.assertEqual(cache.get(), 1)
+        other.invalidate()
+        self.assertEqual(cache.get(), 2)
+        self.assertEqual(other.get(), 3)
+        self.assertEqual(cache.get(), 2)
+
+    def test_network_index(self):
+        index = ProcessCache('network_index', _build_network_index)
+        self.assertIsNone(index.get().find(ipaddress.ip_address('10.0.0.1')))
+        network = Network.objects.create(network='10.0.0.0/24')
+        self.assertEqual(index.get().find(ipaddress.ip_address('10.0.0.1')), network)
+        Network.objects.filter(id=network.id).update(network='10.0.1.0/24')
+        self.assertIsNone(index.get().find(ipaddress.ip_address('10.0.0.1')))
+
+    def test_generation_read_once_per_batch(self):
+        """In a batch the lookups cost a query per cache, not per lookup"""
+        zone = ReverseZone.objects.create(name='0.10.in-addr.arpa', primary_ns='ns.example.org',
+                                          email='hostmaster@example.org')
+        network = Network.objects.create(network='10.0.0.0/24')
+        ReverseZone.get_zone_by_ip('10.0.0.1')
+        Network.get_network_by_ip('10.0.0.1')
+        ForwardZone.get_zone_by_hostname('host1.example.org')
+        with batch_changes():
+            with self.assertNumQueries(2):
+                for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+                    found = ReverseZone.get_zone_by_ip(ip)
+                    self.assertEqual((found.id, found.name), (zone.id, zone.name))
+                    self.assertEqual(Network.get_network_by_ip(ip), network)
+            with self.assertNumQueries(0):
+                ReverseZone.get_zone_by_ip('10.0.0.4')
+            with self.assertNumQueries(1):
+                for name in ('host1.example.org', 'host2.example.org'):
+                    self.assertIsNone(ForwardZone.get_zone_by_hostname(name))
+            forward = ForwardZone.objects.create(name='example.org', primary_ns='ns.example.org',
+                                                 email='hostmaster@example.org')
+            self.assertEqual(ForwardZone.get_zone_by_hostname('host1.example.org'), forward)
+            # Changes made in the batch are seen.
+            other = Network.objects.create(network='10.0.1.0/24')
+            self.assertEqual(Network.get_network_by_ip('10.0.1.1'), other)
+
+
+class ZoneUpdatesTestCase(TestCase):
+    """Zones are marked as updated once, at the end of a batch."""
+
+    def test_zone_updated_at_end_of_batch(self):
+        zone = ForwardZone.objects.create(name='example.org',
+                                          primary_ns='ns.example.org',
+                                          email='hostmaster@example.org',
+                                          updated=False)
+        with CaptureQueriesContext(connection) as queries:
+            with batch_changes():
+                for name in ('host1.example.org', 'host2.example.org'):
+                    host = Host.objects.create(name=name, zone=zone)
+                    Ipaddress.objects.create(host=host, ipaddress='10.0.0.1')
+                zone.refresh_from_db()
+                self.assertFalse(zone.updated)
+        zone.refresh_from_db()
+        self.assertTrue(zone.updated)
+        updates = [query for query in queries if query['sql'].startswith('UPDATE "forward_zone"')]
+        self.assertEqual(len(updates), 1)
+
+    def test_zone_updated_without_batch(self):
+        zone = ForwardZone.objects.create(name='example.org',
+                                          primary_ns='ns.example.org',
+                                          email='hostmaster@example.org',
+                                          updated=False)
+        Host.objects.create(name='host1.example.org', zone=zone)
+        zone.refresh_from_db()
+        self.assertTrue(zone.updated)
+
+
+class HostHistoryTestCase(TestCase):
+    """A host is logged once per batch, not for every record."""
+
+    def test_one_entry_per_host(self):
+        with batch_changes():
+            host = Host.objects.create(name='host.example.org')
+            Ipaddress.objects.create(host=host, ipaddress='10.0.0.1')
+            Ipaddress.objects.create(host=host, ipaddress='10.0.0.2')
+            Txt.objects.create(host=host, txt='some txt')
+            self.assertEqual(ModelChangeLog.objects.count(), 0)
+        entry = ModelChangeLog.objects.get()
+        self.assertEqual((entry.table_row, entry.action), (host.id, 'saved'))
+        self.assertEqual(entry.data['ipaddresses'], ['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(entry.data['txts'], ['some txt'])
+
+    def test_deleted_host(self):
+        with batch_changes():
+            host = Host.objects.create(name='host.example.org')
+            Ipaddress.objects.create(host=host, ipaddress='10.0.0.1')
+        host_id = host.id
+        with batch_changes():
+            host.delete()
+        entry = ModelChangeLog.objects.latest('id')
+        self.assertEqual((entry.table_row, entry.action), (host_id, 'deleted'))
+        self.assertEqual(entry.data['ipaddresses'], ['10.0.0.1'])
+        self.assertEqual(ModelChangeLog.objects.count(), 2)
+
+    def test_rolled_back_batch(self):
+        """The history is written in the transaction of the changes"""
+        with self.assertRaises(ValidationError):
+            with transaction.atomic():
+                with batch_changes():
+                    host = Host.objects.create(name='host.example.org')
+                    Ipaddress.objects.create(host=host, ipaddress='10.0.0.1')
+                self.assertEqual(ModelChangeLog.objects.count(), 1)
+                raise ValidationError('rolled back')
+        self.assertFalse(Host.objects.exists())
+        self.assertFalse(ModelChangeLog.objects.exists())
+
+
+class ModelChangeLogMigrationTestCase(TestCase):
+    """The history saved as text before migration 0005 must be converted to
+    the same data as saved now."""
+
+    def setUp(self):
+        self.migration = importlib.import_module('mreg.migrations.0005_modelchangelog_data_jsonb')
+
+    def test_host_repr(self):
+        ForwardZone.objects.create(name='example.org', primary_ns='ns.example.org',
+                                   email='hostmaster@example.org')
+        host = Host.objects.create(name='host.example.org', contact='mail@example.org',
+                                   ttl=300, comment="it's a host")
+        Ipaddress.objects.create(host=host, ipaddress='10.0.0.1')
+        Txt.objects.create(host=host, txt='v=spf1 -all')
+        Cname.objects.create(host=host, name='alias.example.org')
+        Mx.objects.create(host=host, priority=10, mx='smtp.example.org')
+        Hinfo.objects.create(host=host, cpu='x86', os='linux')
+        Loc.objects.create(host=host, loc='23 58 23 N 10 43 50 E 80m')
+        data = _host_history_entry(Host.objects.get(id=host.id), 'saved').data
+        # The repr of the serializer data is what was saved as text.
+        self.assertEqual(self.migration._parse_repr(str(data)),
+                         json.loads(json.dumps(data, cls=DjangoJSONEncoder)))
+
+    def test_constructor_values(self):
+        text = ("{'at': datetime.date(2019, 10, 1), 'amount': Decimal('1.50'), "
+                "'id': UUID('12345678-1234-5678-1234-567812345678')}")
+        self.assertEqual(self.migration._parse_repr(text),
+                         {'at': '2019-10-01', 'amount': '1.50',
+                          'id': '12345678-1234-5678-1234-567812345678'})
+
+    def test_unparsed(self):
+        text = "{'at': datetime.datetime(2019, 10, 1, tzinfo=<UTC>)}"
+        self.assertEqual(self.migration._parse_repr(text), {'unparsed': text})
+
+
+class ModelChangeLogPartitionTestCase(TestCase):
+    """The history is partitioned by month, and expired months archived."""
+
+    def test_archive_expired(self):
+        old = timezone.now() - timedelta(days=3 * 365)
+        entry = ModelChangeLog.objects.create(table_name='host', table_row=1,
+                                              data={'name': 'old'}, action='saved')
+        ModelChangeLog.objects.filter(id=entry.id).update(timestamp=old)
+        ModelChangeLog.objects.create(table_name='host', table_row=1,
+                                      data={'name': 'new'}, action='saved')
+        with tempfile.TemporaryDirectory() as archive_dir:
+            call_command('history_partitions', keep_months=12, archive_dir=archive_dir,
+                         stdout=StringIO())
+            path = os.path.join(archive_dir, f'model_change_log_{old:%Y_%m}.jsonl.gz')
+            with gzip.open(path, 'rt') as f:
+                archived = [json.loads(line) for line in f]
+        self.assertEqual([i['data'] for i in archived], [{'name': 'old'}])
+        self.assertEqual(list(ModelChangeLog.objects.values_list('data', flat=True)),
+                         [{'name': 'new'}])
+        names = [ModelChangeLog.partition_name(i) for i in ModelChangeLog.get_partitions()]
+        self.assertNotIn(f'model_change_log_{old:%Y_%m}', names)
+        self.assertIn(f'model_change_log_{timezone.now():%Y_%m}', names)
@@ -1,8 +1,12 @@
+import functools
 import ipaddress
 import re
+import threading
 import time
+from contextlib import contextmanager
 
 import idna
+from django.db import connection
 
 
 def clear_none(value):
@@ -50,6 +54,33 @@ def idna_encode(entry):
     return ".".join(res)
 
 
+class NameEncoder:
+    """
+    Qualifies and IDNA encodes names for a single zone, as qualify() and
+    idna_encode() do, for use while exporting the zone. The zone suffix is
+    only computed once, and the IDNA encoding is memoized, as the same
+    names are seen many times in a zonefile.
+    """
+
+    def __init__(self, zone, maxsize=4096):
+        self.zone = zone
+        # qualify() strips the zone and the character in front of it.
+        self._strip = len(zone) + 1
+        self.idna_encode = functools.lru_cache(maxsize=maxsize)(idna_encode)
+
+    def qualify(self, name, shortform=True):
+        """Same as qualify(name, self.zone, shortform)."""
+        if shortform and name.endswith(self.zone):
+            return name[:-self._strip] if len(name) >= self._strip else ''
+        elif not name.endswith("."):
+            name += '.'
+        return name
+
+    def encode(self, name, shortform=True):
+        """Same as idna_encode(qualify(name, self.zone, shortform))."""
+        return self.idna_encode(self.qualify(name, shortform=shortform))
+
+
 def encode_mail(mail):
     """
     Encodes an e-mail address as a name by converting '.' to '\\.' and '@' to '.'
@@ -119,3 +150,153 @@ def get_network_from_zonename(name):
         for i in it:
             net += "%s%s%s%s:" % (i, next(it, '0'), next(it, '0'), next(it, '0'))
         return ipaddress.ip_network("{}:/{}".format(net, netmask))
+
+
+class LabelTrie:
+    """
+    A trie of DNS names, with one level for each label starting from the root.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, name, value):
+        node = self.root
+        for label in reversed(name.split('.')):
+            node = node.setdefault(label, {})
+        # None can never be a label, so it marks the end of a name.
+        node[None] = value
+
+    def find(self, name):
+        """
+        Returns the value for the longest name in the trie which is equal to,
+        or a parent domain of, the given name. None if there is no match.
+        """
+        node = self.root
+        value = None
+        for label in reversed(name.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            value = node.get(None, value)
+        return value
+
+
+class PrefixIndex:
+    """
+    Longest prefix match of IP addresses against a set of networks.
+    """
+
+    def __init__(self):
+        # {version: {prefixlen: {network address as int: value}}}
+        self.prefixes = {4: {}, 6: {}}
+        # {version: prefix lengths, longest first}
+        self.prefixlens = {4: [], 6: []}
+
+    def add(self, network, value):
+        network = ipaddress.ip_network(network)
+        prefixes = self.prefixes[network.version]
+        if network.prefixlen not in prefixes:
+            prefixes[network.prefixlen] = {}
+            self.prefixlens[network.version] = sorted(prefixes, reverse=True)
+        prefixes[network.prefixlen][int(network.network_address)] = value
+
+    def find(self, ip, strict=True):
+        """
+        Returns the value for the longest network containing ip, or None.
+        If strict, a network with only the address itself, e.g. a /32, does
+        not contain it, the same as the net_contains lookup.
+        """
+        ip = ipaddress.ip_address(ip)
+        prefixes = self.prefixes[ip.version]
+        address = int(ip)
+        for prefixlen in self.prefixlens[ip.version]:
+            hostbits = ip.max_prefixlen - prefixlen
+            if strict and hostbits == 0:
+                continue
+            value = prefixes[prefixlen].get(address >> hostbits << hostbits)
+            if value is not None:
+                return value
+        return None
+
+
+_generations = threading.local()
+
+
+@contextmanager
+def cached_generations():
+    """
+    Reads the generation of each ProcessCache at most once in the block,
+    instead of on every get(). Meant to be used around a transaction, as
+    changes committed by other processes during the block are not seen
+    until it ends. A nested block is part of the outermost one.
+    """
+    if getattr(_generations, 'active', None) is not None:
+        yield
+        return
+    _generations.active = dict()
+    try:
+        yield
+    finally:
+        _generations.active = None
+
+
+class ProcessCache:
+    """
+    Keeps a value built by builder in the process, while the generation of
+    name in the lookup_cache_generation table is unchanged. Triggers on the
+    tables the value is built from bump the generation in the transaction
+    changing them, see the migrations, so every process sees the change
+    when it commits, and the transaction itself right away. As a fallback
+    the value is rebuilt when older than max_age seconds.
+    """
+
+    def __init__(self, name, builder, max_age=300):
+        self.name = name
+        self.builder = builder
+        self.max_age = max_age
+        self.data = None
+
+    def get_generation(self):
+        generations = getattr(_generations, 'active', None)
+        if generations is not None and self.name in generations:
+            return generations[self.name]
+        query = "SELECT generation FROM lookup_cache_generation WHERE name = %s"
+        with connection.cursor() as cursor:
+            cursor.execute(query, [self.name])
+            row = cursor.fetchone()
+        generation = 0 if row is None else row[0]
+        if generations is not None:
+            generations[self.name] = generation
+        return generation
+
+    def get(self):
+        generation = self.get_generation()
+        now = time.monotonic()
+        data = self.data
+        if data is None or data[0] != generation or now > data[1]:
+            data = self.data = (generation, now + self.max_age, self.builder())
+        return data[2]
+
+    def forget(self):
+        """
+        Read the generation again on the next get() in a cached_generations()
+        block, after the block changed the tables the value is built from.
+        """
+        generations = getattr(_generations, 'active', None)
+        if generations is not None:
+            generations.pop(self.name, None)
+
+    def invalidate(self):
+        """
+        Bump the generation, for changes the triggers do not see. Other
+        processes see it when the current transaction commits.
+        """
+        query = """
+        INSERT INTO lookup_cache_generation (name, generation)
+            VALUES (%s, nextval('lookup_cache_generation_seq'))
+            ON CONFLICT (name) DO UPDATE SET generation = EXCLUDED.generation
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(query, [self.name])
+        self.forget()
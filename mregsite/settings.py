@@ -74,6 +74,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'mreg.middleware.BatchChangesMiddleware',
 ]
 
 ROOT_URLCONF = 'mregsite.urls'
@@ -199,6 +200,17 @@ TXT_AUTO_RECORDS = {
         'example.org': ('v=spf1 -all', ),
 }
 
+# Seconds a rendered zonefile is kept in the cache. Zones are only cached
+# when they have no pending changes, and entries are keyed on the serialno.
+ZONEFILE_CACHE_TIMEOUT = 86400
+# Zonefiles larger than this many characters are not cached, so they are
+# never held in memory while served. The default cache is kept in every
+# process, so raise it only with a shared cache in CACHES. None for no limit.
+ZONEFILE_CACHE_MAX_SIZE = 8 * 1024 * 1024
+
+# Directory zonefiles are written to by the zonefiles/export/ endpoint.
+ZONEFILE_EXPORT_DIR = None
+
 # Import local settings that may override those in this file.
 try:
     from .local_settings import *  # noqa: F401,F403